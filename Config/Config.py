@@ -1,8 +1,41 @@
 import time
 import json
+from types import MappingProxyType
+from typing import NamedTuple
 from utils import file_utils
 
 
+class SensorRule(NamedTuple):
+    """ Alarm settings of one sensor, precomputed from its config """
+    name: str
+    trigger: float          # Above this the sensor is above threshold
+    release: float          # Below this it is back to normal, trigger - hysteresis
+    resolution: int         # Bits, see TemperatureSensor.apply_resolutions
+
+
+def evaluate_thresholds(readings: dict, rules: dict, above_threshold: dict) -> list:
+    """
+    Updates the sensors above their trigger with a new set of readings.
+    A sensor goes above threshold when its temperature exceeds its trigger and is back
+    to normal once it drops below its release temperature (trigger - hysteresis).
+    
+    :param readings: Dict of sensor serial and its temperature
+    :param rules: SensorRule by serial, see Config.rules
+    :param above_threshold: Sensors above threshold by serial, {"temperature", "name"}, updated in place
+    :return: The entries removed from above_threshold, i.e. sensors back to normal
+    """
+    back_to_normal = []
+    for sensor_serial, temperature in readings.items():
+        rule = rules.get(sensor_serial)
+        if rule is None:      # Reading for which there is no config
+            continue
+        if temperature > rule.trigger:
+            above_threshold[sensor_serial] = {"temperature": temperature, "name": rule.name}
+        elif temperature < rule.release and sensor_serial in above_threshold:
+            back_to_normal.append(above_threshold.pop(sensor_serial))
+    return back_to_normal
+
+
 class Config:
     def __init__(self):
         self.location = ""
@@ -11,15 +44,26 @@ class Config:
         self.armed = False              # On or Off
         self.send_daily_report = False
         self.repeat_alerts = False
-        self.numbers = []               # Acutal phone number list
-        self.daily_numbers = []         # Phone Numbers who want daily report sms
-        self.admins = []                # Phone Numbers of admins
+        self.numbers = ()               # Acutal phone number list
+        self.daily_numbers = ()         # Phone Numbers who want daily report sms
+        self.admins = frozenset()       # Phone Numbers of admins
         self.numbers_list = []          # Phone Number list of dicts
+        self.contacts = MappingProxyType({})    # Phone number -> contact dict (name, number, daily_sms, admin)
+        self.rules = MappingProxyType({})       # Sensor serial -> SensorRule
         self.daily_report_time = ''
+        self.modem_ports = []           # Serial ports of the SIM7600x modems
+        self.sensor_dir = ""            # Folder with the w1 sensor devices
+        self.min_sample_interval = 2    # Seconds between reads of a sensor near its trigger
+        self.max_sample_interval = 30   # Seconds between reads of a cold stable sensor
+        self.version = None             # ConfigStore version the attributes were built from
         self.load_config()  
 
     def load_config(self):
-        data = file_utils.get_data()
+        """Rebuilds the attributes if the configuration changed since the last call"""
+        data, version = file_utils.get_store().snapshot()
+        if version == self.version:
+            return
+        self.version = version
         config = data.get("config",{})                # Empty dict is default
         self.location = config.get("location", self.location)
         self.hysteresis = config.get("hysteresis", self.hysteresis)
@@ -28,13 +72,24 @@ class Config:
         self.armed = config.get("armed", self.armed)
         self.send_daily_report = config.get("send_daily_report", self.send_daily_report)
         self.repeat_alerts = config.get("repeat_alerts", self.repeat_alerts)
+        self.min_sample_interval = config.get("min_sample_interval", self.min_sample_interval)
+        self.max_sample_interval = config.get("max_sample_interval", self.max_sample_interval)
         
+        # Indexes rebuilt once per change so lookups per message and per sensor are O(1)
         self.numbers_list = data.get("numbers", [])   # Empty list is default
-        self.numbers = [entry["number"] for entry in self.numbers_list]
-        self.daily_numbers = [entry["number"] for entry in self.numbers_list if entry["daily_sms"]]
-        self.admins = [entry["number"] for entry in self.numbers_list if entry["admin"]]
+        self.numbers = tuple(entry["number"] for entry in self.numbers_list)
+        self.daily_numbers = tuple(entry["number"] for entry in self.numbers_list if entry["daily_sms"])
+        self.admins = frozenset(entry["number"] for entry in self.numbers_list if entry["admin"])
+        self.contacts = MappingProxyType({entry["number"]: MappingProxyType(entry) for entry in self.numbers_list})
 
         self.sensors = data.get("sensors",{})        # Empty dict is default
+        self.rules = MappingProxyType({
+            serial: SensorRule(info.get("name", "Unknown"), info["trigger"], info["trigger"] - self.hysteresis,
+                               info.get("resolution", 12))
+            for serial, info in self.sensors.items()
+        })
+        self.modem_ports = data.get("modems", ["/dev/ttyS0"])
+        self.sensor_dir = data.get("sensor_dir", "/sys/bus/w1/devices/")
 
 if __name__ == "__main__":
     config_loader = Config()
@@ -1,6 +1,9 @@
-from Config.Config import Config
+from Config.Config import Config, evaluate_thresholds
 from TemperatureSensor import TemperatureSensor
-from SIM7600x import SIM7600x
+from SensorScheduler import SensorScheduler
+from TimeSeriesStore import TimeSeriesStore
+from SMSDispatcher import SMSDispatcher
+from SMSOutbox import SMSPriority
 from UPS import UPS
 import time
 import os
@@ -8,11 +11,25 @@ import json
 import threading
 import schedule
 import traceback
+from types import MappingProxyType
+from typing import NamedTuple, Optional
 from utils import file_utils
 from utils import utils
 from systemd import journal
 
 
+class MonitorSnapshot(NamedTuple):
+    """ State of the monitor at the end of a cycle, never modified once published """
+    version: int                    # Increases with every published snapshot
+    time: float                     # Unix time it was published
+    readings: MappingProxyType      # Sensor serial -> latest temperature
+    above_threshold: MappingProxyType   # Sensor serial -> {"temperature", "name"}
+    power: str                      # 120V-AC or UPS
+    battery: Optional[int]          # Battery percentage, None if it could not be read
+    signal_strength: int
+    network_type: str
+
+
 class LabMonitor(threading.Thread):
     """
     A class to monitor laboratory conditions including temperature and power status.
@@ -22,13 +39,16 @@ class LabMonitor(threading.Thread):
         super(LabMonitor, self).__init__(name="Monitor", **kwargs)
         
         # Initialize configuration and components
-        self.sensor = TemperatureSensor()
-        file_utils.add_new_sensor(self.sensor.sensor_serials) # Add new sensor to config file
-        
         self.config = Config()
+        self.sensor = TemperatureSensor(sensor_dir=self.config.sensor_dir)
+        if file_utils.add_new_sensor(self.sensor.sensor_serials): # Add new sensor to config file
+            self.config.load_config()
+        self.apply_sensor_resolutions()
+        self.scheduler = SensorScheduler(self.config.min_sample_interval, self.config.max_sample_interval)
+        self.series = TimeSeriesStore()     # Temperature history with minute and hour rollups
                 
         self.ups = UPS()
-        self.sms_thread = SIM7600x(parent=self, debug=debug)
+        self.sms_thread = SMSDispatcher(parent=self, ports=self.config.modem_ports, debug=debug)
         self.sms_thread.start()
         
         self.debug: bool = debug
@@ -43,6 +63,8 @@ class LabMonitor(threading.Thread):
         self.low_battery = False
         self.readings: dict = {}
         self.sensors_above_threshold: dict = {} # Dict of sensors serial as key and their temp as value (that are above threshold)
+        self.snapshot: MonitorSnapshot = None   # Published once per cycle, the only state web requests read
+        self.publish_snapshot(battery=None)
 
         self.schedule_daily_status()
         self.log("Initiated an instance of monitor thread")
@@ -58,56 +80,57 @@ class LabMonitor(threading.Thread):
             error = str(err) if str(err) else str(err.__class__.__name__)
             self.log("Thread failed: %s" % error)
             self.log(traceback.format_exc())
+        finally:
+            self.series.close()
             
     def monitor_loop(self):
         """Main logic for Lab Monitor"""
         while not self.end_event.is_set():
             # Read current temperature and power status
-            self.readings = self.sensor.get_readings()  # Dict of sensor serial and its temp {"xxx":xx, ...}
-            if not self.readings:
-                self.log("No sensor readings available. Retrying discovery...")
-                self.sensor.sensor_serials = self.sensor.discover_sensors()
-
-
-            if self.sensor.warning:
-                self.log("Updating sensors.")
-                self.sensor.sensor_serials = self.sensor.discover_sensors()
-                file_utils.add_new_sensor(self.sensor.sensor_serials)
-                self.sensor.warning = False
+            added, removed = self.sensor.scan_devices()     # Picks up plugged in and removed sensors
+            if added:
+                if file_utils.add_new_sensor(added):    # Only writes the config for sensors it has never seen
+                    self.config.load_config()
+                self.apply_sensor_resolutions()
+            for serial in removed:
+                self.scheduler.forget(serial)
+            
+            # Only the sensors whose sampling interval is over are read, see SensorScheduler
+            self.scheduler.set_bounds(self.config.min_sample_interval, self.config.max_sample_interval)
+            due = self.scheduler.due(self.sensor.sensor_serials)
+            fresh = self.sensor.get_readings(due)   # Dict of sensor serial and its temp {"xxx":xx, ...}
+            read_time = time.monotonic()
+            self.series.append(fresh)
+            for serial in due:
+                rule = self.config.rules.get(serial)
+                self.scheduler.update(serial, fresh.get(serial), rule.trigger if rule else None, read_time)
+            # Latest value of every sensor, a sensor that failed or was removed is left out
+            readings = {serial: temperature for serial, temperature in self.readings.items()
+                        if serial not in due and serial not in removed}
+            readings.update(fresh)
+            self.readings = readings    # Swapped whole, the web thread may be iterating the old one
+            if due and not fresh:
+                self.log("No sensor readings available.")
             
             power = self.ups.get_power_source()  # 120V-AC or UPS or None if error
+            battery = self.ups.get_battery_level()  # Percentage or None if error
 
-            self.log(f"Status (Temperature Readings: {self.readings} || Power: {power})")
+            self.log(f"Status (Temperature Readings: {fresh} || Power: {power})")
 
             if self.config.armed:  # If the Alarm is active
                 cur_time = time.time()
                 
-                # Process each sensors reading to check if the temperature is above the trigger threshold
-                for sensor_serial in self.readings:    # Looping through the keys i.e sensor serial
-                    temperature = self.readings[sensor_serial]
-                    if sensor_serial in self.config.sensors:
-                        trigger = self.config.sensors[sensor_serial]['trigger']
-                        if temperature > trigger:
-                            self.sensors_above_threshold[sensor_serial] = {
-                                "temperature": temperature,
-                                "name": self.config.sensors[sensor_serial]['name']
-                            }  
-
-                # Check if temperature has returned to normal
-                for sensor_serial in self.readings:     # Looping through the keys i.e sensor serial
-                    temperature = self.readings[sensor_serial]
-                    if sensor_serial in self.sensors_above_threshold:
-                        trigger = self.config.sensors[sensor_serial]['trigger']
-                        if temperature < trigger - self.config.hysteresis:
-                            self.log(f"{self.sensors_above_threshold[sensor_serial].get('name')} is back to normal temperature")
-                            del self.sensors_above_threshold[sensor_serial]                     # Delete it from the list
-                            
-                            if not self.sensors_above_threshold:     # Only if sensor list gets empty send back to normal message    
-                                self.log("Sending temperature back to normal message")       
-                                self.alert_sent = False
-                                msg = f"Alert Resolved\n\nTemperature is back to normal on {utils.get_rdbl_time()} :)\n\nLocation: {self.config.location}"
-                                self.sms_thread.enqueue_sms(self.config.numbers, msg)
-                                file_utils.write_history("Temperature back to normal")
+                # Check which sensors are above their trigger and which are back to normal
+                back_to_normal = evaluate_thresholds(fresh, self.config.rules, self.sensors_above_threshold)
+                for info in back_to_normal:
+                    self.log(f"{info.get('name')} is back to normal temperature")
+                if back_to_normal and not self.sensors_above_threshold:     # Only if sensor list gets empty send back to normal message    
+                    self.log("Sending temperature back to normal message")       
+                    self.alert_sent = False
+                    msg = f"Alert Resolved\n\nTemperature is back to normal on {utils.get_rdbl_time()} :)\n\nLocation: {self.config.location}"
+                    self.sms_thread.enqueue_sms(self.config.numbers, msg, SMSPriority.RESOLUTION,
+                                                tag="temperature", supersedes=("temperature",))
+                    file_utils.write_history("Temperature back to normal")
 
                 # Send alert if temperature is still high after alert interval
                 cur_time = time.time()
@@ -122,7 +145,8 @@ class LabMonitor(threading.Thread):
                             [f"{info['name']}: {info['temperature']} C" for info in self.sensors_above_threshold.values()]
                         )
                         msg = f"Alert\n\nHigh temperature on {utils.get_rdbl_time()}\n\nSensors Above threshold\n{sensor_details}\n\nLocation: {self.config.location}"
-                        self.sms_thread.enqueue_sms(self.config.numbers, msg)
+                        self.sms_thread.enqueue_sms(self.config.numbers, msg, SMSPriority.CRITICAL,
+                                                    tag="temperature", supersedes=("temperature",))
                         file_utils.write_history("High temperature")
                     
                 # Handle changes in power source
@@ -135,23 +159,25 @@ class LabMonitor(threading.Thread):
                                 self.log("Sending power lost message")
                                 self.last_power_msg = time.time()
                                 self.power_source = power
-                                self.sms_thread.enqueue_sms(self.config.numbers, msg)
+                                self.sms_thread.enqueue_sms(self.config.numbers, msg, SMSPriority.CRITICAL,
+                                                            tag="power", supersedes=("power",))
                         else:   # power is changed to GRID
                             msg = f"Alert Resolved\n\nPower has been recovered on {utils.get_rdbl_time()} :)\n\nLocation: {self.config.location}"
                             self.log("Sending power recovered message")
                             self.last_power_msg = time.time()
                             self.power_source = power
-                            self.sms_thread.enqueue_sms(self.config.numbers, msg)
+                            self.sms_thread.enqueue_sms(self.config.numbers, msg, SMSPriority.RESOLUTION,
+                                                        tag="power", supersedes=("power",))
                         
                 # Case when battery is low 
                 if power == "UPS":
-                    percentage = self.ups.get_battery_level()
+                    percentage = battery
                     if percentage:     # Checking for None
                         low = 20
                         if percentage <= low and self.low_battery == False:
                             self.log("Sending low battery message")
                             msg = f"Alert\n\nBattery is less than {low}% on {utils.get_rdbl_time()}\n\nLocation: {self.config.location}"
-                            self.sms_thread.enqueue_sms(self.config.numbers, msg)
+                            self.sms_thread.enqueue_sms(self.config.numbers, msg, SMSPriority.CRITICAL, tag="battery")
                             file_utils.write_history("Low battery")
                             self.low_battery = True
                         elif percentage > low:
@@ -159,7 +185,10 @@ class LabMonitor(threading.Thread):
                     
                 # Run any scheduled daily status reports
                 schedule.run_pending()
-            time.sleep(self.check_interval)
+            self.publish_snapshot(battery)
+            # Wake up for the next sensor that is due, power is still checked every check_interval
+            next_due = self.scheduler.next_due(self.sensor.sensor_serials) - time.monotonic()
+            self.end_event.wait(min(max(next_due, 0.1), self.check_interval))
             
     def stop(self, block=False):
         """
@@ -170,30 +199,40 @@ class LabMonitor(threading.Thread):
         if block:
             self.join()
             
+    def apply_sensor_resolutions(self):
+        """
+        Applies the resolution of each sensor from the config, called after discovery and when the settings change.
+        """
+        self.sensor.apply_resolutions({serial: rule.resolution for serial, rule in self.config.rules.items()})
+    
+    def publish_snapshot(self, battery: Optional[int]) -> None:
+        """
+        Publishes the state of this cycle for the web and SMS threads. The snapshot is replaced
+        as a whole, so readers get a consistent view without a lock and never touch the hardware.
+        
+        :param battery: Battery percentage read this cycle
+        """
+        self.snapshot = MonitorSnapshot(
+            version=self.snapshot.version + 1 if self.snapshot else 1,
+            time=time.time(),
+            readings=MappingProxyType(dict(self.readings)),
+            above_threshold=MappingProxyType(dict(self.sensors_above_threshold)),
+            power=self.power_source,
+            battery=battery,
+            signal_strength=self.sms_thread.signal_strength,
+            network_type=self.sms_thread.network_type
+        )
+    
     def get_config(self) -> dict:  
         """
-        Get all the information from Config, SIM7600x and Monitor in form of a dictionary
+        Get all the information from Config, SIM7600x and Monitor in form of a dictionary.
+        Measurements come from the last published snapshot, sensor settings from the current
+        config so an edit shows up right away.
         """
-        network_type = self.sms_thread.network_type
-        signal_strength = self.sms_thread.signal_strength
-        battery = self.ups.get_battery_level()
-        battery = 0 if not battery else battery
-
-        # Initialize the intersection list
-        intersection = []
-        for sensor_serial, temperature in self.readings.items():             # loops thru keys   
-            if sensor_serial in self.config.sensors:
-                sensor_info = self.config.sensors[sensor_serial]
-                combined_info = {
-                    "name": sensor_info["name"],
-                    "sensor": sensor_serial,
-                    "trigger": sensor_info["trigger"],
-                    "temperature": temperature
-                }
-                intersection.append(combined_info)
-            
+        snapshot = self.snapshot
         return {
-                "high_temperature": bool(self.sensors_above_threshold), 
+                "version": snapshot.version,
+                "high_temperature": bool(snapshot.above_threshold), 
                 "location": self.config.location,
                 "hys": self.config.hysteresis, 
                 "interval": self.config.alert_interval / 60, 
@@ -201,14 +240,34 @@ class LabMonitor(threading.Thread):
                 "armed": self.config.armed,
                 "send_daily_report": self.config.send_daily_report,
                 "repeat_alerts": self.config.repeat_alerts,
-                "signal_strength": signal_strength, 
-                "signal_type": network_type, 
+                "signal_strength": snapshot.signal_strength, 
+                "signal_type": snapshot.network_type, 
                 "pi_time": utils.get_rdbl_time(),  
                 "numbers": self.config.numbers_list,
-                "power": self.power_source,
-                "battery": self.ups.get_battery_level(),
-                "sensors": intersection
+                "power": snapshot.power,
+                "battery": snapshot.battery or 0,
+                "sensors": self.sensor_rows(snapshot.readings)
                 }
+    
+    def sensor_rows(self, readings) -> list:
+        """
+        Combines readings with the current settings of each configured sensor.
+        
+        :param readings: Dict of sensor serial and its temperature
+        """
+        rules = self.config.rules
+        rows = []
+        for serial, temperature in readings.items():
+            rule = rules.get(serial)
+            if rule is not None:
+                rows.append({
+                    "name": rule.name,
+                    "sensor": serial,
+                    "trigger": rule.trigger,
+                    "resolution": rule.resolution,
+                    "temperature": temperature
+                })
+        return rows
  
     def schedule_daily_status(self):
         """
@@ -225,12 +284,15 @@ class LabMonitor(threading.Thread):
         """
         if self.config.send_daily_report:
             self.log("Sending daily status report...")
-            sorted_keys = sorted(self.readings, key=lambda k: self.config.sensors[k]['name'])
+            rules = self.config.rules
+            readings = {serial: temperature for serial, temperature in self.readings.items() if serial in rules}
+            sorted_keys = sorted(readings, key=lambda k: rules[k].name)
             sensor_details = "\n".join(
-                            [f"{self.config.sensors[key]['name']}: {self.readings[key]} C" for key in sorted_keys]
+                            [f"{rules[key].name}: {readings[key]} C" for key in sorted_keys]
                         )
             msg = f"Daily Report\nLocation: {self.config.location}\n\n{sensor_details}\n\nPower: {self.power_source}\nTime: {utils.get_rdbl_time()}"
-            self.sms_thread.enqueue_sms(self.config.daily_numbers, msg)
+            self.sms_thread.enqueue_sms(self.config.daily_numbers, msg, SMSPriority.REPORT,
+                                        tag="daily_report", supersedes=("daily_report",))
             
     def log(self, message):
         """
@@ -244,11 +306,9 @@ class LabMonitor(threading.Thread):
         Replies to SMS by the users of the Monitor after Authenticating and Authorizing, returns None if it cannot authenticate
         """
         text = text.lower()
-        if num in self.config.numbers:  # Check if the message came from the list of numbers in the database
-            name = ''
-            for contact in self.config.numbers_list:        # Getting the name corresponding to the number
-                 if contact['number'] == num:
-                    name = contact['name']
+        contact = self.config.contacts.get(num)
+        if contact is not None:  # Check if the message came from the list of numbers in the database
+            name = contact['name']
         
             if text == 'status':  # Same for admin and normal users
                 config = self.get_config()
@@ -257,7 +317,7 @@ class LabMonitor(threading.Thread):
                 repeat_alerts = f"Alert Interval: {int(config['interval'])} minutes" if config['repeat_alerts'] else f"Repeat Alerts: {config['repeat_alerts']}"
                 
                 sensor_details = "\n".join(
-                            [f"{self.config.sensors[key]['name']}: {self.readings[key]} C" for key in self.readings]
+                            [f"{sensor['name']}: {sensor['temperature']} C" for sensor in self.sensor_rows(self.snapshot.readings)]
                         )
                 file_utils.write_history(f"Status request by {name}")
                 return f"Arm/Disarm: {armed}\nSignal Strength: {signal_strength} (0-31)\nPower: {config['power']}\n{repeat_alerts}\n\n{sensor_details}"
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Optional
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 90.0)   # Upper bounds in seconds
+
+
+class CommandStats:
+    """ Latency histogram and outcomes of one AT command """
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)    # Last bucket counts everything slower
+        self.timeouts = 0
+        self.errors: Counter = Counter()                    # Error result code -> count
+
+    def record(self, seconds: float, error: Optional[str], timed_out: bool) -> None:
+        """Adds one command to the histogram"""
+        self.count += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+        self.buckets[next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+                          len(LATENCY_BUCKETS))] += 1
+        if timed_out:
+            self.timeouts += 1
+        if error:
+            self.errors[error] += 1
+
+    def to_dict(self) -> dict:
+        """Returns the stats as plain data for JSON"""
+        return {
+            "count": self.count,
+            "mean": round(self.total_time / self.count, 3) if self.count else 0,
+            "max": round(self.max_time, 3),
+            "histogram": {f"<={bound}s": n for bound, n in zip(LATENCY_BUCKETS, self.buckets)} |
+                         {f">{LATENCY_BUCKETS[-1]}s": self.buckets[-1]},
+            "timeouts": self.timeouts,
+            "errors": dict(self.errors),
+        }
+
+
+class ModemMetrics:
+    """
+    In-memory counters for the modem, bounded in size so they can run forever.
+    Tracks per AT command latency and outcomes, send results per recipient and
+    how long messages waited in the outbox before they were delivered to the network.
+    """
+    def __init__(self, max_commands: int = 50, max_recipients: int = 200, max_deliveries: int = 200):
+        self.lock = threading.Lock()        # Written by the modem thread, read by the web thread
+        self.max_commands = max_commands
+        self.max_recipients = max_recipients
+        self.started = time.time()
+        self.commands: dict[str, CommandStats] = {}
+        self.recipients: OrderedDict = OrderedDict()            # Number -> {"sent", "failed"}, least recent first
+        self.deliveries: deque = deque(maxlen=max_deliveries)    # Most recent delivered messages
+
+    @staticmethod
+    def command_name(command: str) -> str:
+        """Returns the name a command is tracked under, e.g. 'AT+CMGS' for 'AT+CMGS=25', message bodies are 'BODY'"""
+        command = command.strip()
+        if not command.upper().startswith("AT"):
+            return "BODY"
+        return command.split("=")[0].split(";")[0]
+
+    @staticmethod
+    def error_code(reply: str) -> Optional[str]:
+        """Returns the error result code of a reply, e.g. '+CMS ERROR: 500', or None"""
+        for line in reversed(reply.splitlines()):
+            line = line.strip()
+            if line == "ERROR" or line.startswith(("+CME ERROR", "+CMS ERROR")):
+                return line
+        return None
+
+    def record_command(self, command: str, seconds: float, reply: str, timed_out: bool) -> None:
+        """Records the latency and outcome of an AT command"""
+        name = self.command_name(command)
+        with self.lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                if len(self.commands) >= self.max_commands:
+                    return
+                stats = self.commands[name] = CommandStats()
+            stats.record(seconds, self.error_code(reply), timed_out)
+
+    def record_send(self, number: str, success: bool) -> None:
+        """Records the result of sending a message to a recipient"""
+        with self.lock:
+            stats = self.recipients.pop(number, None) or {"sent": 0, "failed": 0}
+            stats["sent" if success else "failed"] += 1
+            self.recipients[number] = stats
+            if len(self.recipients) > self.max_recipients:
+                self.recipients.popitem(last=False)
+
+    def record_delivery(self, number: str, priority: str, tag: Optional[str], queued: float, sent: float,
+                        attempts: int) -> None:
+        """Records how long a message took from enqueue_sms to being accepted by the network"""
+        with self.lock:
+            self.deliveries.append({"number": number, "priority": priority, "tag": tag, "queued": queued,
+                                    "time_to_deliver": round(sent - queued, 2), "attempts": attempts})
+
+    def snapshot(self) -> dict:
+        """Returns a copy of all the metrics as plain data"""
+        with self.lock:
+            recipients = {number: dict(stats, success_rate=round(stats["sent"] / (stats["sent"] + stats["failed"]), 3))
+                          for number, stats in self.recipients.items()}
+            return {
+                "uptime": round(time.time() - self.started),
+                "commands": {name: stats.to_dict() for name, stats in self.commands.items()},
+                "recipients": recipients,
+                "deliveries": list(self.deliveries),
+            }
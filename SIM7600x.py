@@ -1,227 +1,794 @@
+import asyncio
+import os
 import serial
 import time
 import threading
-import queue
 from typing import List, Tuple, Optional
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
 from systemd import journal
+from SMSOutbox import SMSOutbox, SMSMessage, SMSPriority
+from ModemMetrics import ModemMetrics
+from utils import sms_pdu
 
-class SMSMessage:
-    """ Represents an SMS message """
-    def __init__(self, phone_number: str, message: str):
-        self.phone_number = phone_number
-        self.message = message
-        
-    def __iter__(self) -> iter:
-        """Used to directly unpack an object"""
-        return iter((self.phone_number, self.message))
+FINAL_RESULT_CODES = (b'OK', b'ERROR', b'NO CARRIER', b'NO DIALTONE', b'BUSY', b'NO ANSWER')
+FINAL_ERROR_PREFIXES = (b'+CME ERROR', b'+CMS ERROR')
+PROMPT = b'>'
+
+DEFAULT_COMMAND_TIMEOUT = 10.0
+COMMAND_TIMEOUTS = {            # Worst case response times from the SIM7600 AT command manual
+    'AT+CMGS': 10.0,            # Only waits for the '>' prompt, the message body has its own timeout
+    'AT+CMGL': 20.0,
+    'AT+CMGD': 10.0,
+    'AT+CPMS': 10.0,
+    'AT+CPSI': 9.0,
+    'AT+CSQ': 9.0,
+    'AT&F': 5.0,
+}
+
+URC_PREFIXES = (b'+CMTI', b'+CDS', b'RING', b'+CREG', b'+CGREG', b'+CEREG')   # Unsolicited result codes we handle
+REGISTERED_STATES = ('1', '5')  # Registered on home network or roaming
+
+SESSION_COMMANDS = (            # Session settings applied once after power up or recovery instead of per message
+    'AT+CMGF=1\r',                     # Text mode
+    'AT+CSCS="GSM"\r',                 # GSM character set
+    'AT+CPMS="SM","SM","SM"\r',        # SMS storage on the SIM
+    'AT+CNMI=2,1,0,0,0\r',             # +CMTI when a new message is stored
+    'AT+CREG=1\r',                     # +CREG when the network registration changes
+)
+CFUN_RESET_TIME = 20            # Seconds the module needs to reboot after AT+CFUN=1,1
+SIGNAL_INTERVAL = 10.0          # Seconds between signal refreshes
+PART_TIMEOUT = 600.0            # Seconds to wait for the missing parts of a concatenated message
+PRUNE_INTERVAL = 3600.0         # Seconds between deleting old sent and cancelled messages from the outbox
+READ_SIZE = 4096                # Bytes read from the serial port at once
+
+
+class ModemState(Enum):
+    """ States of the modem session """
+    INIT = "INIT"                   # Not configured yet (power up or after a reboot)
+    CONFIGURED = "CONFIGURED"       # Session settings applied, not registered to a network
+    REGISTERED = "REGISTERED"       # Ready to send and receive SMS
+    DEGRADED = "DEGRADED"           # Health probe failed, retrying before escalating
+    RECOVERING = "RECOVERING"       # Resetting the modem after repeated failures
 
 class SIM7600x(threading.Thread):
     """
     A class to interact with the SIM7600x modem for sending SMS messages and monitoring signal strength.
-    Runs as a separate thread.
+    Runs an asyncio event loop in a separate thread: the serial port is read by a reader task and the
+    health probe, signal refresh, inbox and outbox each run as their own task, taking turns on the
+    port through a command lock instead of blocking each other for seconds.
+    enqueue_sms, get_stats and stop are safe to call from other threads.
     According to the PI you are using, the user UART device of Raspberry Pi 2B/Zero is ttyAMA0, and ttyS0 of Raspberry Pi 3B.
     """
-    def __init__(self, parent, port: str = "/dev/ttyS0", debug: bool = False, **kwargs):
+    def __init__(self, parent, port: str = "/dev/ttyS0", debug: bool = False, health_check_interval: float = 30.0,
+                 max_failed_checks: int = 3, outbox_path: str = "Config/outbox.db", coalesce_window: float = 60.0,
+                 coalesce_max_parts: int = 4, use_pdu: bool = True, outbox: Optional[SMSOutbox] = None, **kwargs):
         super(SIM7600x, self).__init__(name="SIM7600x", **kwargs)
-        
+
         self.parent = parent
-        self.ser = serial.Serial(port, 115200, timeout=5)  # Opening serial port at provided port 
+        self.port = port
+        self.ser = serial.Serial(port, 115200, timeout=0)  # Non-blocking, reads are driven by the event loop
         if not self.ser.is_open:
             self.ser.open()
         self.debug = debug
         self.end_event = threading.Event()
-        self.sms_queue: queue.Queue = queue.Queue()
-        self.failed_sms_list: list[SMSMessage] = []
-        
+        # Outbound messages, persisted so a restart does not lose alerts. Shared when several modems send from one outbox
+        self.outbox = outbox if outbox is not None else SMSOutbox(outbox_path)
+        self.coalesce_window = coalesce_window          # Seconds a queued message can absorb new ones to the same number
+        self.coalesce_max_parts = coalesce_max_parts    # Parts a coalesced message may grow to
+        self.use_pdu = use_pdu                  # Send in PDU mode: GSM-7/UCS-2 encoding and concatenated parts
+        self.pdu_mode: Optional[bool] = None    # Current AT+CMGF setting, None if unknown
+        self.concat_reference: int = 0          # Reference of the last concatenated message
+        self.metrics = ModemMetrics()           # Command latencies and delivery results, see get_stats()
+        # Received commands are answered here so the event loop never waits on parent.handle_message
+        self.handler_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SIM7600x-handler")
+        self.partial_sms: dict = {}             # (number, reference, total) -> parts of a concatenated message so far
+
+        # Event loop state, created in main() as asyncio objects belong to the loop they run on
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.command_lock: Optional[asyncio.Lock] = None    # Only one command can be in flight at a time
+        self.sms_lock: Optional[asyncio.Lock] = None        # Held around AT+CMGF dependent exchanges (send, list)
+        self.state_lock: Optional[asyncio.Lock] = None      # Only one task advances the session state machine
+        self.stop_signal: Optional[asyncio.Event] = None
+        self.send_event: Optional[asyncio.Event] = None     # Set when there may be a message to send
+        self.inbox_event: Optional[asyncio.Event] = None    # Set by +CMTI, i.e. there is an unread SMS to fetch
+        self.signal_event: Optional[asyncio.Event] = None   # Set by +CREG to refresh the signal data early
+
+        # State shared between send_command and the reader task
+        self.response_future: Optional[asyncio.Future] = None
+        self.response_lines: list[bytes] = []
+        self.response_prefix: bytes = b""       # e.g. b'+CREG' for 'AT+CREG?', so the reply is not taken for a URC
+        self.expected_resp: Optional[bytes] = None
+        self.urc_handlers = {
+            b'+CMTI': self.on_new_sms,
+            b'+CDS': self.on_status_report,
+            b'RING': self.on_ring,
+            b'+CREG': self.on_registration_change,
+            b'+CGREG': self.on_registration_change,
+            b'+CEREG': self.on_registration_change,
+        }
+
+        # Session state machine, see ensure_ready()
+        self.state: ModemState = ModemState.INIT
+        self.health_check_interval = health_check_interval  # Seconds between 'AT' probes
+        self.max_failed_checks = max_failed_checks          # Failed probes before resetting the modem
+        self.failed_checks: int = 0
+        self.last_health_check: float = time.time()
+
         self.signal_strength: str = ""
         self.network_type: str = ""
-        self.last_signal_update: float = time.time()
-        self.update_signal_data()
-        self.send_command('AT+CPMS="SM","SM","SM"\r', 'OK')  # Set SMS storage to SIM 
-        self.send_command('AT+CMGD=1,4\r', 'OK')             # Delete all messages
-        
+        self.last_signal_update: float = 0
+
     def run(self) -> None:
-        """ Main thread function, runs the SMS loop"""
+        """ Main thread function, runs the event loop until stop() is called"""
         try:
-            self.sms_loop()
+            asyncio.run(self.main())
         except Exception as err:
             error = str(err) if str(err) else str(err.__class__.__name__)
             self.log(f"Thread failed: {error}")
             self.error = f"Unhandled exception: {error}"
             self.log(traceback.format_exc())
-    
-    def enqueue_sms(self, numbers: List[str], message: str) -> None:
+        finally:
+            self.handler_pool.shutdown(wait=False)
+            if self.ser.is_open:
+                self.ser.close()
+                self.log("Serial Port is now closed")
+
+    async def main(self) -> None:
         """
-        Enqueues SMS messages for multiple recipients.
-        
+        Sets up the modem and runs the reader, health, signal, inbox and send tasks until stop() is called.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.command_lock = asyncio.Lock()
+        self.sms_lock = asyncio.Lock()
+        self.state_lock = asyncio.Lock()
+        self.stop_signal = asyncio.Event()
+        self.send_event = asyncio.Event()
+        self.inbox_event = asyncio.Event()      # Also set by configure(), see there
+        self.signal_event = asyncio.Event()
+        if self.end_event.is_set():             # Stopped before the loop was running
+            return
+
+        tasks = [asyncio.create_task(coro, name=coro.__name__) for coro in
+                 (self.read_loop(), self.health_loop(), self.signal_loop(), self.inbox_loop(), self.send_loop())]
+        for task in tasks:
+            task.add_done_callback(self.task_done)
+
+        await self.stop_signal.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def task_done(self, task: asyncio.Task) -> None:
+        """Logs a task that stopped with an exception, which would otherwise go unnoticed until stop()"""
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            self.log(f"Task {task.get_name()} failed: {error or error.__class__.__name__}")
+            self.log("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+    def enqueue_sms(self, numbers: List[str], message: str, priority: SMSPriority = SMSPriority.REPLY,
+                    tag: Optional[str] = None, supersedes: Tuple[str, ...] = ()) -> None:
+        """
+        Enqueues SMS messages for multiple recipients. Safe to call from any thread.
+
         :param numbers: List of phone numbers to send the message to
         :param message: The message content
+        :param priority: Message class, alerts are sent before replies and reports
+        :param tag: Topic of the message e.g. 'temperature'
+        :param supersedes: Topics whose unsent messages are cancelled, e.g. an alert once it is resolved
         """
-         # Converting one message into mulitple if it is long
         self.log(f"Sending messages to {numbers} Text:")
         self.log(message)
-        message_parts = self.partition_message(message)
-        for number in numbers:
-            for msg in message_parts:
-                self.sms_queue.put((number, msg))
-        # self.log(f"This is queue now {self.sms_queue}")
-                 
-    def sms_loop(self) -> None:
-        """
-        Main loop for sending SMS, recieving SMS and updating signal data.
-        """
-        while not self.end_event.is_set():
-            reply = self.send_command('AT&F\r', 'OK')
-            if not (reply.endswith('OK') or 'ERROR' in reply):
-                self.signal_strength = 0
-                self.network_type = "NO SERVICE"
-                self.send_command('\r', 'OK')
-                self.send_command('\032', 'OK')
-                time.sleep(1)
+        counts = self.outbox.enqueue([(number, message) for number in numbers], priority, tag, supersedes,
+                                     coalesce_window=self.coalesce_window, fits=self.fits_in_parts)
+        if any(counts.values()):
+            self.log(f"Queued with {counts['cancelled']} superseded, {counts['coalesced']} coalesced "
+                     f"and {counts['duplicates']} duplicate message(s)")
+        self.wake()
+
+    def wake(self) -> None:
+        """Wakes the send task, e.g. after a message was queued. Safe to call from any thread"""
+        if self.loop is None or self.send_event is None:
+            return      # Not running yet, the send task checks the outbox when it starts
+        try:
+            self.loop.call_soon_threadsafe(self.send_event.set)
+        except RuntimeError:
+            pass        # The loop has already stopped
+
+    def fits_in_parts(self, message: str) -> bool:
+        """Checks if a coalesced message is still short enough to send"""
+        if self.use_pdu:
+            return sms_pdu.count_parts(message) <= self.coalesce_max_parts
+        return len(self.partition_message(message)) <= self.coalesce_max_parts
+
+    async def health_loop(self) -> None:
+        """
+        Configures the modem, then advances the session state machine every second,
+        probing the modem every health_check_interval.
+        """
+        async with self.sms_lock:
+            if await self.configure():
+                await self.query_signal()
+        while True:
+            was_ready = self.state == ModemState.REGISTERED
+            if await self.ensure_ready() and not was_ready:
+                self.send_event.set()       # Send what queued up while the modem was not ready
+            await asyncio.sleep(1)
+
+    async def signal_loop(self) -> None:
+        """
+        Refreshes the signal data every SIGNAL_INTERVAL seconds, or right away when the registration changes.
+        Without service it is refreshed every second so sending resumes as soon as the network is back.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self.signal_event.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+            due = (self.signal_event.is_set() or self.network_type == "NO SERVICE"
+                   or time.time() - self.last_signal_update >= SIGNAL_INTERVAL)
+            self.signal_event.clear()
+            if due and self.state in (ModemState.CONFIGURED, ModemState.REGISTERED):
+                await self.query_signal()
+
+    async def inbox_loop(self) -> None:
+        """
+        Fetches received SMS whenever the modem reports a new one.
+        """
+        while True:
+            await self.inbox_event.wait()
+            if self.state not in (ModemState.CONFIGURED, ModemState.REGISTERED):
+                await asyncio.sleep(1)      # Keep the event set and try again once the modem is usable
                 continue
-        
-            if self.last_signal_update < time.time() - 10 or self.network_type =="NO SERVICE":
-                self.update_signal_data()
-                if self.network_type == "NO SERVICE":
-                    continue
-                                    
-            self.check_recieved_sms()
-            
-            while not self.sms_queue.empty():
-                try:
-                    sms = self.sms_queue.get_nowait()
-                except queue.Empty:
-                    break
-                self.send_sms(sms)
-                
-            # if network is online, check for failed messages  
-            # if self.network_type != "NO SERVICE": 
-            #     temp_list = []
-            #     for sms in self.failed_sms_list:
-            #         if not self.send_sms(sms): # Failed to send message
-            #             temp_list.append(sms)
-            #     self.failed_sms_list = temp_list
-                    
-    def send_sms(self, sms: SMSMessage, retries: int = 3) -> bool:
-        """
-        Sends an SMS message with retry logic.
-        
+            self.inbox_event.clear()
+            async with self.sms_lock:
+                await self.check_recieved_sms()
+
+    async def send_loop(self) -> None:
+        """
+        Sends queued messages whenever something is queued, wakes up on its own when a retry is due.
+        Prunes the outbox every PRUNE_INTERVAL so sent messages do not pile up while the process runs for months.
+        """
+        last_prune = time.monotonic()
+        while True:
+            if time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                self.outbox.prune()
+                last_prune = time.monotonic()
+            next_due = self.outbox.next_due()
+            if next_due is None or self.state != ModemState.REGISTERED:
+                timeout = 5.0       # The health task wakes us once the modem is registered
+            else:
+                timeout = min(5.0, max(0.1, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self.send_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.send_event.clear()
+            await self.send_queued_sms()
+
+    async def send_queued_sms(self) -> None:
+        """
+        Sends every message in the outbox that is due, failed messages are retried later with backoff.
+        The SMS lock is released between messages so replies to commands are not stuck behind a long queue.
+        """
+        while self.state == ModemState.REGISTERED:
+            sms = self.outbox.claim_next(fits=self.fits_in_parts)
+            if sms is None:
+                return
+            async with self.sms_lock:
+                if self.use_pdu:
+                    sent = await self.send_pdu_sms(sms)
+                else:
+                    # Converting one message into mulitple if it is long
+                    sent = True
+                    for part in self.partition_message(sms.message):
+                        if not await self.send_sms(SMSMessage(sms.phone_number, part), retries=1):
+                            sent = False
+                            break
+            self.metrics.record_send(sms.phone_number, sent)
+            if sent:
+                self.outbox.mark_sent(sms)
+                self.metrics.record_delivery(sms.phone_number, sms.priority.name, sms.tag, sms.created, time.time(),
+                                             sms.attempts + 1)
+            elif not await self.ensure_ready():
+                # The modem lost the network, not the message's fault: hand it back right away
+                # so another modem can send it or this one once it recovers
+                self.log(f"Modem not ready, releasing message {sms.id} to {sms.phone_number}")
+                self.outbox.release(sms)
+            elif self.outbox.mark_failed(sms, error=f"Failed on {self.network_type}"):
+                self.log(f"Will retry message {sms.id} to {sms.phone_number}")
+            else:
+                self.log(f"Giving up on message {sms.id} to {sms.phone_number} after {sms.attempts + 1} attempts")
+
+    async def ensure_ready(self) -> bool:
+        """
+        Advances the modem session state machine.
+        INIT -> CONFIGURED -> REGISTERED, a failed 'AT' probe moves to DEGRADED and
+        repeated failures to RECOVERING (AT&F first, AT+CFUN reset if that does not help).
+
+        :return: True if the modem is registered and ready to send and receive SMS
+        """
+        async with self.state_lock:
+            if self.state in (ModemState.INIT, ModemState.RECOVERING):
+                if not await self.configure():
+                    await self.health_check_failed()
+                    return False
+                await self.query_signal()
+
+            health_check_due = time.time() - self.last_health_check > self.health_check_interval
+            if self.state == ModemState.DEGRADED or health_check_due:
+                self.last_health_check = time.time()
+                if not (await self.send_command('AT\r', 'OK')).endswith('OK'):
+                    await self.health_check_failed()
+                    return False
+                if self.state == ModemState.DEGRADED:
+                    self.log("Modem is responding again")
+                    self.state = ModemState.CONFIGURED
+                    await self.query_signal()
+                self.failed_checks = 0
+
+            if self.network_type == "NO SERVICE":
+                self.state = ModemState.CONFIGURED
+                return False
+            self.state = ModemState.REGISTERED
+            return True
+
+    async def configure(self) -> bool:
+        """
+        Applies the session settings once, they stay in effect until the modem is reset.
+        Every new session reads the inbox once, SMS may have arrived while the modem was
+        not configured and their +CMTI was lost.
+
+        :return: True if all the settings were accepted
+        """
+        self.pdu_mode = None
+        for command in SESSION_COMMANDS:
+            if not (await self.send_command(command, 'OK')).endswith('OK'):
+                self.log(f"Failed to configure modem with {command.strip()}")
+                return False
+        self.pdu_mode = False
+        self.state = ModemState.CONFIGURED
+        self.inbox_event.set()
+        self.log("Modem configured")
+        return True
+
+    async def health_check_failed(self) -> None:
+        """
+        Records a failed health probe and escalates to a reset after repeated failures.
+        """
+        self.failed_checks += 1
+        self.signal_strength = 0
+        self.network_type = "NO SERVICE"
+        self.log(f"Modem health check failed {self.failed_checks} time(s)")
+        if self.failed_checks < self.max_failed_checks:
+            self.state = ModemState.DEGRADED
+            await asyncio.sleep(1)
+            return
+
+        self.state = ModemState.RECOVERING
+        self.pdu_mode = None
+        await self.send_command('\033', 'OK', timeout=2)      # ESC, cancels a stuck '>' prompt
+        if self.failed_checks < 2 * self.max_failed_checks:
+            self.log("Restoring modem factory defaults")
+            await self.send_command('AT&F\r', 'OK')
+        else:
+            self.log("Rebooting modem")
+            await self.send_command('AT+CFUN=1,1\r', 'OK')
+            self.failed_checks = 0
+            self.state = ModemState.INIT
+            await asyncio.sleep(CFUN_RESET_TIME)
+
+    async def send_sms(self, sms: SMSMessage, retries: int = 3) -> bool:
+        """
+        Sends an SMS message in text mode with retry logic.
+        Callers hold sms_lock so the inbox task cannot switch the message format in between.
+
         :param sms: SMSMessage object containing phone number and message
         :param retries: Number of retry attempts
         :return: True if message sent successfully, False otherwise
-        """   
+        """
         phone_number, message = sms
-        parts = [message[i:i+160] for i in range(0, len(message), 160)] # Splitting the message into 160 character strings if longer than 160 characters
-        try: 
+        if not await self.set_pdu_mode(False):
+            return False
+        try:
             for i in range(retries):
-                if 'OK' in self.send_command('AT+CSCS="GSM"\r', 'OK'):
-                    if 'OK' in self.send_command('AT+CMGF=1\r', 'OK'):
-                        if '>' in self.send_command(f'AT+CMGS="{phone_number}"\r', '>'):
-                            if '+CMGS:' in self.send_command(f'{message}\r\032', 'OK', timeout=90.0):
-                                self.log("Message sent successfully")
-                                return True
+                async with self.command_lock:   # Nothing else may be written between the prompt and the body
+                    if '>' in await self.exchange(f'AT+CMGS="{phone_number}"\r', '>'):
+                        if '+CMGS:' in await self.exchange(f'{message}\r\032', 'OK', timeout=90.0):
+                            self.log("Message sent successfully")
+                            return True
                 self.log(f"Failed Attempt {i+1}")
-            self.log("Failed to send message after 3 tries")
+                self.last_health_check = 0      # Probe the modem before the next attempt
+            self.log(f"Failed to send message after {retries} tries")
             return False
         except Exception as e:
             self.log(f"Failed to send message: {e}")
             return False
-                            
-    def send_command(self, command: str, valid_resp: str, timeout: float = 10.0) -> str:
+
+    async def send_pdu_sms(self, sms: SMSMessage) -> bool:
+        """
+        Sends a message in PDU mode, long messages are sent as concatenated parts
+        that the handset shows as one message.
+        Callers hold sms_lock so the inbox task cannot switch the message format in between.
+
+        :param sms: SMSMessage object containing phone number and message
+        :return: True if every part was sent successfully, False otherwise
+        """
+        if not await self.set_pdu_mode(True):
+            return False
+        self.concat_reference = (self.concat_reference + 1) % 256
+        try:
+            pdus = sms_pdu.build_submit_pdus(sms.phone_number, sms.message, self.concat_reference)
+            async with self.command_lock:       # Nothing else may be written between the prompt and the body
+                for pdu, length in pdus:
+                    if '>' not in await self.exchange(f'AT+CMGS={length}\r', '>'):
+                        break
+                    if '+CMGS:' not in await self.exchange(f'{pdu}\032', 'OK', timeout=90.0):
+                        break
+                else:
+                    self.log(f"Message sent successfully in {len(pdus)} part(s)")
+                    return True
+        except Exception as e:
+            self.log(f"Failed to send message: {e}")
+        self.last_health_check = 0      # Probe the modem before the next attempt
+        return False
+
+    async def set_pdu_mode(self, enabled: bool) -> bool:
+        """
+        Switches between PDU (AT+CMGF=0) and text (AT+CMGF=1) mode, only talks to the modem if the mode changes.
+
+        :return: True if the modem is in the requested mode
+        """
+        if self.pdu_mode == enabled:
+            return True
+        if (await self.send_command(f'AT+CMGF={0 if enabled else 1}\r', 'OK')).endswith('OK'):
+            self.pdu_mode = enabled
+            return True
+        self.pdu_mode = None
+        return False
+
+    async def send_command(self, command: str, valid_resp: str, timeout: Optional[float] = None) -> str:
         """
         Sends a command to the modem and waits for a valid response.
-        
+        Returns as soon as the expected response or any final result code
+        (OK, ERROR, +CME ERROR, +CMS ERROR, > prompt) arrives instead of
+        waiting for the whole timeout. Other tasks keep running while it waits.
+
         :param command: Command to send
         :param valid_resp: Expected valid response
-        :param timeout: Timeout for waiting for response
+        :param timeout: Timeout for waiting for response, defaults to the per-command timeout
         :return: Decoded response from the modem
         """
-        if not self.ser.isOpen():
-            self.ser.open()
-        if self.ser.timeout != timeout:
-            self.ser.timeout = timeout
-            
+        async with self.command_lock:
+            return await self.exchange(command, valid_resp, timeout)
+
+    async def exchange(self, command: str, valid_resp: str, timeout: Optional[float] = None) -> str:
+        """
+        Same as send_command for callers that already hold command_lock, so an exchange
+        spanning several commands (AT+CMGS, '>' prompt, message body) is not interleaved with other tasks.
+        """
+        if timeout is None:
+            timeout = self.command_timeout(command)
+
         command = bytes(command, encoding="ascii", errors='replace')
         valid_resp = bytes(valid_resp, encoding="ascii", errors="replace")
 
-        self.ser.write(command)
-        time.sleep(1)
+        self.response_lines = []
+        self.response_prefix = self.response_prefix_of(command)
+        self.expected_resp = valid_resp
+        self.response_future = self.loop.create_future()
+        start = time.monotonic()
+        timed_out = False
         try:
-            data = self.ser.read_until(valid_resp)
-        except OSError:
-            data = b""
+            await self.write(command)
+            await asyncio.wait_for(self.response_future, timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            self.log(f"Timed out after {timeout}s waiting for {valid_resp}")
+        except OSError as e:
+            timed_out = True
+            self.log(f"Failed to write to modem: {e}")
+        finally:
+            self.expected_resp = None       # Lines arriving from now on are unsolicited
+            self.response_prefix = b""
+            self.response_future = None
+        elapsed = time.monotonic() - start
+        lines = self.response_lines
 
-        lines = data.splitlines()
         if lines and lines[0] == command.strip(b'\r\n'):
             lines = lines[1:]
         if len(lines) > 1 and not lines[0] and lines[1] == command.strip(b'\r\n'):
             lines = lines[2:]
         reply = b'\n'.join(lines).decode('latin1').strip()
         self.log(f"Command: {command}, Reply: {reply}")
+        self.metrics.record_command(command.decode('latin1'), elapsed, reply, timed_out)
         return reply
+
+    async def write(self, data: bytes) -> None:
+        """
+        Writes to the non-blocking serial port, yielding to other tasks while the UART buffer is full.
+
+        :param data: Bytes to write
+        """
+        fd = self.ser.fileno()
+        while data:
+            try:
+                data = data[os.write(fd, data):]
+            except BlockingIOError:
+                await asyncio.sleep(0.01)
+
+    async def read_loop(self) -> None:
+        """
+        Reader task, reads everything the modem sends as soon as the port is readable and splits it into
+        command responses (handed to send_command) and unsolicited result codes (handed to urc_handlers).
+        """
+        fd = self.ser.fileno()
+        readable = asyncio.Event()
+        self.loop.add_reader(fd, readable.set)
+        buffer = b""
+        empty_reads = 0
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                try:
+                    chunk = os.read(fd, READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    self.log(f"Failed to read from modem: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not chunk:
+                    # The tty returns nothing instead of EAGAIN when a readiness event was already consumed,
+                    # only back off if it keeps happening, i.e. the port hung up
+                    empty_reads += 1
+                    if empty_reads > 100:
+                        await asyncio.sleep(0.1)
+                    continue
+                empty_reads = 0
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    self.handle_line(line.rstrip(b'\r'))
+                if buffer.strip() == PROMPT and self.expected_resp is not None:    # Prompt is not followed by a newline
+                    buffer = b""
+                    self.handle_line(PROMPT)
+        finally:
+            self.loop.remove_reader(fd)
+
+    def handle_line(self, line: bytes) -> None:
+        """
+        Routes one line from the modem to the pending command or to its URC handler.
+
+        :param line: A line from the modem without the line ending
+        """
+        stripped = line.strip()
+        if self.is_urc(stripped) and not (self.response_prefix and stripped.startswith(self.response_prefix)):
+            handler = self.urc_handlers[stripped.split(b':')[0]]
+            try:
+                handler(stripped.decode('latin1'))
+            except Exception as e:
+                self.log(f"Error handling unsolicited code {stripped}: {e}")
+            return
+
+        if self.expected_resp is None:
+            if stripped:
+                self.log(f"Unexpected line from modem: {stripped}")
+            return
+        self.response_lines.append(line)
+        if self.is_final_line(stripped, self.expected_resp) and not self.response_future.done():
+            self.response_future.set_result(None)
+
+    @staticmethod
+    def is_urc(line: bytes) -> bool:
+        """
+        Checks if a line is an unsolicited result code we have a handler for.
+        
+        :param line: A stripped line from the modem
+        """
+        return line == b'RING' or (line.startswith(URC_PREFIXES) and line.split(b':')[0] in URC_PREFIXES)
     
-    def check_recieved_sms(self):
-        self.send_command('AT+CMGF=1\r', 'OK')
+    @staticmethod
+    def is_final_line(line: bytes, valid_resp: bytes = b"") -> bool:
+        """
+        Checks if a line ends a command, i.e. it is the expected response, a final result code
+        or the '>' prompt of AT+CMGS.
+        Matching whole lines keeps an 'OK' inside a message text from ending the read early.
         
-        reply=self.send_command('AT+CMGL="REC UNREAD"\r', 'OK')
-        # Example message in modem:  +CMGL: 1,"REC READ","+123","","24/10/17,12:14:52-16" \nThis is a simple message 
-        if '+CMGL:' in reply:
-            lines = reply.split("\n")
-            for i in range(len(lines)):
-                if '+CMGL:' in lines[i]:
-                    details = lines[i].replace('"', '').split(',')
-                    if len(details) >= 3:
-                        index = details[0].replace('+CMGL: ', '')
-                        number = details[2]
-                        message = lines[i+1].strip()
-                        
-                        self.log(f"Recieved message from {number}: {message}")
-                        response = self.parent.handle_message(number,message)
-                        if response:
-                            self.enqueue_sms([number], response)
-                        else:
-                            self.log(f"Unknown messager {number}")
-                            
-                        self.send_command(f'AT+CMGD={index}\r', 'OK')   # Delete the message after reading it
-
-
-                     
+        :param line: A stripped line from the modem
+        :param valid_resp: Expected valid response
+        :return: True if the command has finished
+        """
+        return (line == valid_resp or line == PROMPT or line in FINAL_RESULT_CODES
+                or line.startswith(FINAL_ERROR_PREFIXES))
+    
+    @staticmethod
+    def response_prefix_of(command: bytes) -> bytes:
+        """
+        Returns the prefix of the information response of an AT command, e.g. b'+CREG' for b'AT+CREG?'.
+        
+        :param command: Command being sent
+        """
+        if not command.startswith(b'AT+'):
+            return b""
+        name = command[2:].split(b'=')[0].split(b'?')[0].split(b';')[0]
+        return name.strip()
+    
+    @staticmethod
+    def command_timeout(command: str) -> float:
+        """
+        Returns the timeout for a command based on its prefix.
+        
+        :param command: Command to send
+        :return: Timeout in seconds
+        """
+        for prefix, timeout in COMMAND_TIMEOUTS.items():
+            if command.startswith(prefix):
+                return timeout
+        return DEFAULT_COMMAND_TIMEOUT
+    
+
+    async def check_recieved_sms(self) -> None:
+        """
+        Drains the inbox in two round trips however many messages are waiting: one AT+CMGL lists
+        everything, one AT+CMGD deletes every message that was read. Parts of concatenated messages
+        are joined before they are answered. parent.handle_message runs in the handler thread so
+        config writes never hold up the modem. Callers hold sms_lock.
+        The inbox is always listed in PDU mode, whatever use_pdu is for sending: a message body is
+        then a hex line that can never be taken for the final OK, so a text reply of "OK" cannot
+        end the listing early and get unparsed messages deleted.
+        """
+        if not await self.set_pdu_mode(True):
+            return
+        # Example message: +CMGL: 1,1,,24 \n07913174...
+        reply = await self.send_command('AT+CMGL=4\r', 'OK')
+        lines = reply.splitlines()
+        if not lines or lines[-1] != 'OK':
+            return
+        indexes = []
+        for sms in sms_pdu.parse_cmgl(lines[:-1]):
+            indexes.append(sms["index"])
+            if sms["text"] is None:
+                self.log(f"Could not decode message {sms['index']}, deleting it")
+                continue
+            text = self.add_part(sms) if sms["concat"] else sms["text"]
+            if text is not None:
+                self.log(f"Recieved message from {sms['number']}: {text}")
+                self.handler_pool.submit(self.answer, sms["number"], text)
+        self.expire_parts()
+        if indexes:
+            # Listing marked everything as read, delflag 1 deletes all read messages and keeps any that just arrived
+            await self.send_command(f'AT+CMGD={indexes[0]},1\r', 'OK')
+
+    def add_part(self, sms: dict) -> Optional[str]:
+        """
+        Stores one part of a concatenated message.
+
+        :param sms: Message from sms_pdu.parse_cmgl with a concat (reference, total, seq) tuple
+        :return: The whole text once every part has arrived, otherwise None
+        """
+        reference, total, seq = sms["concat"]
+        key = (sms["number"], reference, total)
+        entry = self.partial_sms.setdefault(key, {"parts": {}, "first": time.time()})
+        entry["parts"][seq] = sms["text"]
+        if len(entry["parts"]) < total:
+            return None
+        del self.partial_sms[key]
+        return "".join(entry["parts"][i] for i in sorted(entry["parts"]))
+
+    def expire_parts(self) -> None:
+        """Drops concatenated messages whose missing parts did not arrive within PART_TIMEOUT"""
+        now = time.time()
+        for key, entry in list(self.partial_sms.items()):
+            if now - entry["first"] > PART_TIMEOUT:
+                self.log(f"Dropping incomplete message from {key[0]}, {len(entry['parts'])}/{key[2]} parts arrived")
+                del self.partial_sms[key]
+
+    def answer(self, number: str, message: str) -> None:
+        """
+        Runs parent.handle_message in the handler thread and queues the reply.
+
+        :param number: Sender of the message
+        :param message: Text of the message
+        """
+        try:
+            response = self.parent.handle_message(number, message)
+        except Exception as e:
+            self.log(f"Failed to handle message from {number}: {e}")
+            self.log(traceback.format_exc())
+            return
+        if response:
+            self.enqueue_sms([number], response, SMSPriority.REPLY)
+        else:
+            self.log(f"Unknown messager {number}")
+
+    def on_new_sms(self, urc: str) -> None:
+        """
+        Handles +CMTI: "SM",<index>, wakes the inbox task to fetch the new message.
+        Runs in the reader task so must not wait for commands.
+        """
+        self.log(f"New message indication: {urc}")
+        self.inbox_event.set()
+
+    def on_status_report(self, urc: str) -> None:
+        """Handles +CDS delivery status reports"""
+        self.log(f"Delivery status report: {urc}")
+
+    def on_ring(self, urc: str) -> None:
+        """Handles RING for incoming calls, calls are not answered"""
+        self.log("Incoming call")
+
+    def on_registration_change(self, urc: str) -> None:
+        """
+        Handles +CREG/+CGREG/+CEREG: <stat>[,...], marks the network as lost or
+        wakes the signal task when the registration changes.
+        Runs in the reader task so must not wait for commands.
+        """
+        self.log(f"Network registration changed: {urc}")
+        stat = urc.split(':', 1)[1].split(',')[0].strip()
+        if stat not in REGISTERED_STATES:
+            self.signal_strength = 0
+            self.network_type = "NO SERVICE"
+        self.signal_event.set()
+
+    def get_stats(self) -> dict:
+        """
+        Returns the modem metrics along with the session state and outbox backlog.
+        """
+        oldest = self.outbox.oldest_pending()
+        stats = self.metrics.snapshot()
+        stats.update({
+            "state": self.state.value,
+            "signal_strength": self.signal_strength,
+            "network_type": self.network_type,
+            "queue_depth": self.outbox.pending_count(),
+            "oldest_queued_age": round(time.time() - oldest, 1) if oldest else 0,
+        })
+        return stats
+
     def log(self, message: str) -> None:
         """
         Logs a message if debug mode is enabled.
-        
+
         :param message: Message to log
         """
         if self.debug:
             journal.send(message)
-    
+
     def stop(self, block: bool = False) -> None:
         """
         Signals the thread to stop and optionally waits for it to finish.
-        
+        The serial port is closed by the thread once its tasks are cancelled.
+
         :param block: If True, waits for the thread to finish
         """
         self.end_event.set()
-        if self.ser.is_open:
+        if self.loop is not None and self.stop_signal is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.stop_signal.set)
+            except RuntimeError:
+                pass        # The loop has already stopped
+        elif not self.is_alive() and self.ser.is_open:
             self.ser.close()
             self.log("Serial Port is now closed")
         if block:
-            self.join() 
-    
-    def update_signal_data(self) -> None:
+            self.join()
+
+    async def query_signal(self) -> None:
         """
         Updates the signal strength and network type data.
         """
         self.log("Updating Signal data")
         self.last_signal_update = time.time()
-        
-        csq_output = self.send_command("AT+CSQ\r", "OK")
+
+        csq_output = await self.send_command("AT+CSQ\r", "OK")
         self.signal_strength = self.interpret_signal_strength(csq_output)
-        
-        cpsi_output = self.send_command("AT+CPSI?\r", "OK")
+
+        cpsi_output = await self.send_command("AT+CPSI?\r", "OK")
         self.network_type = self.interpret_network_type(cpsi_output)
-        
+
     def interpret_signal_strength(self, csq_output: str) -> int:
         """
         Interprets the signal quality from the CSQ command output.
@@ -0,0 +1,326 @@
+import os
+import pty
+import random
+import threading
+import time
+import tty
+import argparse
+from typing import Dict, List, Optional
+from utils import sms_pdu
+
+
+class SIM7600xEmulator(threading.Thread):
+    """
+    Emulates a SIM7600x modem on a pseudo-terminal so the SMS path can run without hardware.
+    Pass emulator.port to SIM7600x(port=...) in place of /dev/ttyS0.
+
+    Speaks the subset of AT commands the driver uses (AT, AT&F, AT+CSQ, AT+CPSI?, AT+CMGF,
+    AT+CSCS, AT+CMGS in text and PDU mode, AT+CMGL, AT+CMGD, AT+CPMS, AT+CNMI, AT+CREG, AT+CFUN)
+    with echo on, like the real module. Latency, errors, inbound SMS and signal loss can be injected.
+    Sent messages are recorded in self.sent with the time they were accepted.
+    """
+    def __init__(self, latency: float = 0.05, send_latency: float = 1.0, error_rate: float = 0.0,
+                 seed: Optional[int] = None, **kwargs):
+        super(SIM7600xEmulator, self).__init__(name="SIM7600xEmulator", daemon=True, **kwargs)
+        self.latency = latency              # Seconds before answering a command
+        self.send_latency = send_latency    # Seconds the network takes to accept a message after Ctrl-Z
+        self.error_rate = error_rate        # Probability of answering a command with ERROR
+        self.unresponsive = False           # If True commands get no answer at all, like a hung module
+        self.random = random.Random(seed)
+
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.port: str = os.ttyname(slave)
+        self.end_event = threading.Event()
+        self.lock = threading.Lock()        # Writes to the pty come from the emulator and injecting threads
+
+        # Modem state
+        self.echo = True
+        self.text_mode = True               # AT+CMGF
+        self.cnmi = False                   # +CMTI on new messages
+        self.creg = False                   # +CREG on registration changes
+        self.registered = True
+        self.rssi = 20
+        self.network = "LTE"
+        self.storage: Dict[int, dict] = {}  # Messages on the SIM by index
+        self.reference = 0                  # Concatenation reference of the last long inbound message
+        self.sent: List[dict] = []          # {"number", "text" or "pdu", "time"} of every accepted message
+        self.commands: List[str] = []       # Every command received, for inspecting round trips
+
+        self.pending_send: Optional[str] = None     # AT+CMGS argument while waiting for the message body
+        self.buffer = b""
+
+    def run(self) -> None:
+        """Reads from the pty and answers like the modem would"""
+        while not self.end_event.is_set():
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            self.buffer += data
+            self.process_buffer()
+
+    def process_buffer(self) -> None:
+        """Splits the input into command lines or, after a '>' prompt, the message body ended by Ctrl-Z"""
+        while True:
+            if self.pending_send is not None:
+                end = min((i for i in (self.buffer.find(b"\x1a"), self.buffer.find(b"\x1b")) if i != -1), default=-1)
+                if end == -1:
+                    return
+                body, terminator, self.buffer = self.buffer[:end], self.buffer[end:end + 1], self.buffer[end + 1:]
+                if self.echo:
+                    self.write(body)
+                if terminator == b"\x1a":
+                    self.handle_body(body.decode("latin1"))
+                else:
+                    self.pending_send = None        # ESC cancels the message
+                    self.reply("OK")
+                continue
+
+            end = self.buffer.find(b"\r")
+            if end == -1:
+                return
+            line, self.buffer = self.buffer[:end], self.buffer[end + 1:]
+            line = line.strip(b"\n")
+            if self.echo:
+                self.write(line + b"\r")
+            if line:
+                self.handle_line(line.decode("latin1"))
+
+    def write(self, data: bytes) -> None:
+        """Writes raw bytes to the driver"""
+        with self.lock:
+            try:
+                os.write(self.master, data)
+            except OSError:
+                pass
+
+    def reply(self, *lines: str) -> None:
+        """Writes information lines as one CR LF framed block followed by the result code, like the modem"""
+        *info, result = lines
+        data = b"\r\n" + "\r\n".join(info).encode("latin1") + b"\r\n" if info else b""
+        self.write(data + b"\r\n" + result.encode("latin1") + b"\r\n")
+
+    def urc(self, line: str) -> None:
+        """Writes an unsolicited result code"""
+        self.reply(line)
+
+    def handle_line(self, line: str) -> None:
+        """Answers a command line, commands joined with ';' are run in order"""
+        self.commands.append(line)
+        if self.unresponsive:
+            return
+        time.sleep(self.latency)
+        if not line.upper().startswith("AT"):
+            self.reply("ERROR")
+            return
+        if self.random.random() < self.error_rate:
+            self.reply("+CMS ERROR: 500" if "CMGS" in line.upper() else "ERROR")
+            return
+
+        info = []
+        commands = line[2:].split(";")
+        for command in commands:
+            command = command.strip()
+            if command.upper().startswith("+CMGS"):
+                if not self.registered:
+                    self.reply(*info, "+CMS ERROR: 331")     # No network service
+                    return
+                self.pending_send = command.split("=", 1)[1].strip('"')
+                self.write(b"\r\n> ")
+                return
+            result = self.run_command(command)
+            if result is None:
+                self.reply(*info, "ERROR")
+                return
+            info.extend(result)
+        self.reply(*info, "OK")
+
+    def run_command(self, command: str) -> Optional[List[str]]:
+        """
+        Runs one command without the AT prefix.
+
+        :return: Information response lines or None for ERROR
+        """
+        name, _, arg = command.partition("=")
+        name = name.upper()
+        if name == "" or name in ("+CSCS", "+CPMS"):
+            return []
+        if name == "&F":
+            self.text_mode, self.cnmi, self.creg, self.echo = False, False, False, True
+            return []
+        if name in ("E0", "E1"):
+            self.echo = name == "E1"
+            return []
+        if name == "+CSQ":
+            return [f"+CSQ: {self.rssi if self.registered else 99},99"]
+        if name == "+CPSI?":
+            if not self.registered:
+                return ["+CPSI: NO SERVICE,Online"]
+            return [f"+CPSI: {self.network},Online,302-720,0x1234,12345678,123,EUTRAN-BAND2,875,5,5,-94,-1041,-741,15"]
+        if name == "+CMGF":
+            self.text_mode = arg.strip() == "1"
+            return []
+        if name == "+CNMI":
+            self.cnmi = arg.split(",")[1:2] == ["1"]
+            return []
+        if name == "+CREG":
+            self.creg = arg.strip() != "0"
+            return []
+        if name == "+CREG?":
+            return [f"+CREG: {int(self.creg)},{1 if self.registered else 0}"]
+        if name == "+CFUN":
+            return []
+        if name == "+CMGL":
+            return self.list_messages(arg.strip('"'))
+        if name == "+CMGD":
+            return self.delete_messages(arg)
+        return None
+
+    def list_messages(self, stat: str) -> List[str]:
+        """AT+CMGL in text ("REC UNREAD", "ALL") or PDU (0, 4) mode, unread messages are marked as read"""
+        if not self.text_mode:
+            stat = {"0": "REC UNREAD", "1": "REC READ", "4": "ALL"}.get(stat, stat)
+        lines = []
+        for index, sms in sorted(self.storage.items()):
+            if stat == "ALL" or stat == sms["stat"]:
+                if self.text_mode:
+                    lines.append(f'+CMGL: {index},"{sms["stat"]}","{sms["number"]}","","{sms["timestamp"]}"')
+                    lines.extend(sms["text"].split("\n"))
+                else:
+                    lines.append(f'+CMGL: {index},{0 if sms["stat"] == "REC UNREAD" else 1},,{sms["length"]}')
+                    lines.append(sms["pdu"])
+                sms["stat"] = "REC READ"
+        return lines
+
+    def delete_messages(self, arg: str) -> List[str]:
+        """AT+CMGD=<index>[,<delflag>], delflag 1 deletes read, 4 deletes all"""
+        index, _, flag = arg.partition(",")
+        flag = int(flag or 0)
+        if flag == 4:
+            self.storage.clear()
+        elif flag == 1:
+            self.storage = {i: sms for i, sms in self.storage.items() if sms["stat"] != "REC READ"}
+        else:
+            self.storage.pop(int(index), None)
+        return []
+
+    def handle_body(self, body: str) -> None:
+        """Accepts a message body after the '>' prompt"""
+        target, self.pending_send = self.pending_send, None
+        time.sleep(self.send_latency)
+        if not self.registered:
+            self.reply("+CMS ERROR: 331")
+            return
+        if self.random.random() < self.error_rate:
+            self.reply("+CMS ERROR: 500")
+            return
+        if self.text_mode:
+            self.sent.append({"number": target, "text": body.rstrip("\r"), "time": time.time()})
+        else:
+            pdu = body.strip()
+            self.sent.append({"number": self.pdu_destination(pdu), "pdu": pdu, "length": int(target),
+                              "time": time.time()})
+        self.reply(f"+CMGS: {len(self.sent) % 256}", "OK")
+
+    @staticmethod
+    def pdu_destination(pdu: str) -> str:
+        """Returns the destination number of an SMS-SUBMIT PDU in hex"""
+        data = bytes.fromhex(pdu)
+        offset = data[0] + 1 + 2                # SMSC, first octet and message reference
+        digits, toa = data[offset], data[offset + 1]
+        swapped = data[offset + 2:offset + 2 + (digits + 1) // 2].hex().upper()
+        number = "".join(swapped[i + 1] + swapped[i] for i in range(0, len(swapped), 2))[:digits]
+        return ("+" if toa == 0x91 else "") + number
+
+    def inject_sms(self, number: str, text: str) -> List[int]:
+        """
+        Stores an inbound SMS on the SIM and announces it with +CMTI if enabled.
+        Long texts arrive as concatenated parts, one storage index each.
+
+        :return: Storage indexes of the parts
+        """
+        self.reference = (self.reference + 1) % 256
+        indexes = []
+        for pdu, length in sms_pdu.build_deliver_pdus(number, text, self.reference):
+            index = max(self.storage, default=0) + 1
+            self.storage[index] = {"stat": "REC UNREAD", "number": number, "pdu": pdu, "length": length,
+                                   "text": sms_pdu.parse_deliver_pdu(pdu)["text"],    # What text mode shows of the part
+                                   "timestamp": time.strftime("%y/%m/%d,%H:%M:%S-16")}
+            indexes.append(index)
+            if self.cnmi:
+                self.urc(f'+CMTI: "SM",{index}')
+        return indexes
+
+    def set_registered(self, registered: bool) -> None:
+        """Simulates losing or regaining the network, reported with +CREG if enabled"""
+        self.registered = registered
+        if self.creg:
+            self.urc(f"+CREG: {1 if registered else 0}")
+
+    def stop(self) -> None:
+        """Closes the pty"""
+        self.end_event.set()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def benchmark(count: int, latency: float, send_latency: float, error_rate: float) -> None:
+    """Measures messages per minute and alert latency of the SIM7600x driver against the emulator"""
+    from SIM7600x import SIM7600x
+    from SMSOutbox import SMSPriority
+
+    class Parent:
+        def handle_message(self, number, text):
+            return "OK"
+
+    emulator = SIM7600xEmulator(latency=latency, send_latency=send_latency, error_rate=error_rate, seed=1)
+    emulator.start()
+    outbox_path = f"/tmp/sim7600x_bench_{os.getpid()}.db"
+    modem = SIM7600x(parent=Parent(), port=emulator.port, outbox_path=outbox_path, coalesce_window=0)
+    modem.start()
+
+    start = time.time()
+    for i in range(count):
+        modem.enqueue_sms([f"+1555000{i:04d}"], f"Report {i}", SMSPriority.REPORT)
+    time.sleep(send_latency)
+    alert_time = time.time()
+    modem.enqueue_sms(["+15559999999"], "Alert\n\nHigh temperature", SMSPriority.CRITICAL)
+    deadline = start + 60 + count * (send_latency + 4 * latency) * 2
+    while len(emulator.sent) < count + 1 and time.time() < deadline:
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    alert_sent = next((sms["time"] for sms in emulator.sent if sms["number"] == "+15559999999"), None)
+    modem.stop(block=True)
+    emulator.stop()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(outbox_path + suffix):
+            os.remove(outbox_path + suffix)
+
+    print(f"Sent {len(emulator.sent)}/{count + 1} messages in {elapsed:.1f}s "
+          f"({len(emulator.sent) / elapsed * 60:.1f} messages/minute)")
+    print(f"Commands sent to the modem: {len(emulator.commands)}")
+    if alert_sent:
+        print(f"Alert latency behind {count} queued reports: {alert_sent - alert_time:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIM7600x emulator on a pseudo-terminal")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before answering a command")
+    parser.add_argument("--send-latency", type=float, default=1.0, help="Seconds to accept a message")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of an ERROR reply")
+    parser.add_argument("--bench", type=int, metavar="N", help="Send N messages through SIM7600x and report throughput")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.latency, args.send_latency, args.error_rate)
+    else:
+        emulator = SIM7600xEmulator(latency=args.latency, send_latency=args.send_latency, error_rate=args.error_rate)
+        emulator.start()
+        print(f"Emulating SIM7600x on {emulator.port}, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            emulator.stop()
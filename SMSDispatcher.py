@@ -0,0 +1,88 @@
+import time
+import traceback
+from typing import List, Optional, Tuple
+from systemd import journal
+from SIM7600x import SIM7600x, ModemState
+from SMSOutbox import SMSOutbox, SMSPriority
+
+
+class SMSDispatcher:
+    """
+    Drives one or more SIM7600x modems (one per serial port) that send from a shared outbox.
+    Each modem runs its own thread and claims the next due message whenever it is idle and
+    registered, so messages are spread over the healthy modems and fan-out time drops with the
+    number of modems. A modem that loses the network hands its message back for another one.
+    Inbound SMS on every modem are still answered by parent.handle_message.
+
+    Has the same interface as SIM7600x for LabMonitor: start, stop, enqueue_sms,
+    signal_strength, network_type and get_stats.
+    """
+    def __init__(self, parent, ports: List[str], debug: bool = False, outbox_path: str = "Config/outbox.db",
+                 **modem_kwargs):
+        self.debug = debug
+        self.outbox = SMSOutbox(outbox_path)
+        self.modems: List[SIM7600x] = []
+        for port in ports:
+            try:
+                self.modems.append(SIM7600x(parent=parent, port=port, debug=debug, outbox=self.outbox, **modem_kwargs))
+            except Exception as err:
+                self.log(f"Could not open modem on {port}: {err}")
+                self.log(traceback.format_exc())
+        if not self.modems:
+            raise RuntimeError(f"No modem could be opened on {ports}")
+        self.log(f"Dispatching SMS over {len(self.modems)} modem(s)")
+
+    def start(self) -> None:
+        """Starts every modem thread"""
+        for modem in self.modems:
+            modem.start()
+
+    def stop(self, block: bool = False) -> None:
+        """Stops every modem thread, waits for them if block is True"""
+        for modem in self.modems:
+            modem.stop(block=block)
+
+    def enqueue_sms(self, numbers: List[str], message: str, priority: SMSPriority = SMSPriority.REPLY,
+                    tag: Optional[str] = None, supersedes: Tuple[str, ...] = ()) -> None:
+        """
+        Enqueues SMS messages for multiple recipients and wakes every modem, see SIM7600x.enqueue_sms.
+        """
+        self.modems[0].enqueue_sms(numbers, message, priority, tag, supersedes)   # Writes to the shared outbox
+        for modem in self.modems[1:]:
+            modem.wake()
+
+    def best_modem(self) -> SIM7600x:
+        """Returns the registered modem with the strongest signal, or the first one if none is registered"""
+        registered = [modem for modem in self.modems if modem.state == ModemState.REGISTERED]
+        if not registered:
+            return self.modems[0]
+        return max(registered, key=lambda modem: modem.signal_strength or 0)
+
+    @property
+    def signal_strength(self) -> int:
+        """Signal strength of the best modem (0-31)"""
+        return self.best_modem().signal_strength
+
+    @property
+    def network_type(self) -> str:
+        """Network type of the best modem i.e 2G, 3G, 4G or NO SERVICE"""
+        return self.best_modem().network_type
+
+    def get_stats(self) -> dict:
+        """Returns the stats of every modem by port along with the shared outbox backlog and unsent messages"""
+        oldest = self.outbox.oldest_pending()
+        return {
+            "queue_depth": self.outbox.pending_count(),
+            "oldest_queued_age": round(time.time() - oldest, 1) if oldest else 0,
+            "dead_letters": {"count": self.outbox.dead_count(), "latest": self.outbox.dead_letters(10)},
+            "modems": {modem.port: modem.get_stats() for modem in self.modems},
+        }
+
+    def log(self, message: str) -> None:
+        """
+        Logs a message if debug mode is enabled.
+
+        :param message: Message to log
+        """
+        if self.debug:
+            journal.send(message)
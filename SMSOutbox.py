@@ -0,0 +1,302 @@
+import sqlite3
+import threading
+import time
+from enum import IntEnum
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class SMSPriority(IntEnum):
+    """ Message classes, lower value is sent first """
+    CRITICAL = 0        # Alerts: high temperature, power lost, low battery
+    RESOLUTION = 1      # Alert resolved messages
+    REPLY = 2           # Replies to SMS commands
+    REPORT = 3          # Daily status reports
+
+
+MERGED_CLASSES = (int(SMSPriority.CRITICAL), int(SMSPriority.RESOLUTION))    # Sent together to one number
+
+
+class SMSMessage:
+    """ Represents an SMS message """
+    def __init__(self, phone_number: str, message: str, id: Optional[int] = None, attempts: int = 0,
+                 priority: SMSPriority = SMSPriority.REPLY, tag: Optional[str] = None, created: Optional[float] = None,
+                 merged_ids: Tuple[int, ...] = ()):
+        self.phone_number = phone_number
+        self.message = message
+        self.id = id                # Row id in the outbox, None if not stored
+        self.merged_ids = merged_ids    # Rows of other alerts sent in the same SMS, see SMSOutbox.claim_next
+        self.attempts = attempts    # Failed send attempts so far
+        self.priority = priority
+        self.tag = tag              # Topic of the message e.g. 'temperature', used to cancel superseded messages
+        self.created = created      # Time the message was queued
+
+    def __iter__(self) -> iter:
+        """Used to directly unpack an object"""
+        return iter((self.phone_number, self.message))
+
+
+class SMSOutbox:
+    """
+    Persistent queue of outbound SMS stored in SQLite, so queued alerts survive a restart.
+
+    Every message is a row with a state:
+        pending  -> waiting to be sent (possibly after a retry delay)
+        sending  -> handed to the modem, moved back to pending on startup if we crashed mid send
+        sent     -> delivered to the network, pruned after a while
+        dead     -> gave up after max_attempts, kept for inspection
+        cancelled -> superseded by a newer message on the same topic before it was sent
+    Enqueueing a burst is a single transaction, nothing is ever rewritten as a whole.
+
+    Messages are sent by priority class, a waiting message gains one class every
+    aging_time seconds so reports are delayed by alerts but never starved. Aging stops just below
+    CRITICAL, so a backlog of old reports or replies never goes out before a new alert.
+    Messages to the same number can be coalesced into one while they wait, and
+    exact duplicates of a waiting message are dropped.
+    """
+    def __init__(self, file_path: str = "Config/outbox.db", max_attempts: int = 8, base_delay: float = 10.0,
+                 max_delay: float = 900.0, keep_sent: float = 7 * 24 * 3600, aging_time: float = 120.0):
+        self.max_attempts = max_attempts    # Attempts before a message goes to the dead letters
+        self.base_delay = base_delay        # Retry delay after the first failure, doubles after each failure
+        self.max_delay = max_delay          # Upper bound for the retry delay
+        self.keep_sent = keep_sent          # Seconds to keep sent messages before pruning them
+        self.aging_time = aging_time        # Seconds of waiting that raise a message by one priority class
+        self.lock = threading.Lock()        # The connection is shared by the monitor, web and modem threads
+
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")     # Appends without rewriting the database file
+        self.conn.execute("PRAGMA synchronous=FULL")     # A queued alert must survive a power cut
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    number TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    next_attempt REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    last_error TEXT,
+                    priority INTEGER NOT NULL DEFAULT 2,
+                    tag TEXT
+                )""")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")]
+            if "priority" not in columns:   # Outbox created before priorities were added
+                self.conn.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 2")
+                self.conn.execute("ALTER TABLE outbox ADD COLUMN tag TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_tag ON outbox (tag, state)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_number ON outbox (number, state)")
+        self.recover()
+        self.prune()
+
+    def recover(self) -> int:
+        """
+        Moves messages that were being sent when the process stopped back to pending.
+
+        :return: Number of recovered messages
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute("UPDATE outbox SET state = 'pending' WHERE state = 'sending'")
+        return cursor.rowcount
+
+    def enqueue(self, messages: List[Tuple[str, str]], priority: SMSPriority = SMSPriority.REPLY,
+                tag: Optional[str] = None, supersedes: Iterable[str] = (), coalesce_window: float = 0.0,
+                fits: Optional[Callable[[str], bool]] = None) -> Dict[str, int]:
+        """
+        Stores messages in a single transaction.
+        A message identical to one still waiting for the same number is dropped. With a coalesce_window,
+        a message is appended to a message of the same class and topic queued for the same number within
+        the window, as long as the combined text still fits. This merges replies; alerts on different
+        topics are merged when they are sent instead, see claim_next.
+
+        :param messages: List of (phone number, message) tuples
+        :param priority: Message class
+        :param tag: Topic of the messages, e.g. 'temperature'
+        :param supersedes: Topics whose unsent messages are cancelled by these ones
+        :param coalesce_window: Seconds a waiting message can still absorb new ones, 0 disables coalescing
+        :param fits: Returns True if a combined text is short enough to send, e.g. within a number of parts
+        :return: Number of cancelled, coalesced and duplicate messages
+        """
+        now = time.time()
+        supersedes = list(supersedes)
+        counts = {"cancelled": 0, "coalesced": 0, "duplicates": 0}
+        with self.lock, self.conn:
+            if supersedes:
+                cursor = self.conn.execute(
+                    f"UPDATE outbox SET state = 'cancelled', updated = ? WHERE state = 'pending' "
+                    f"AND tag IN ({', '.join('?' * len(supersedes))})", (now, *supersedes))
+                counts["cancelled"] = cursor.rowcount
+            
+            rows = []
+            for number, message in dict.fromkeys(messages):     # Also drops duplicates within the batch
+                if self.conn.execute("SELECT 1 FROM outbox WHERE number = ? AND state = 'pending' AND message = ?",
+                                     (number, message)).fetchone():
+                    counts["duplicates"] += 1
+                    continue
+                if coalesce_window > 0 and self._coalesce(number, message, priority, tag, now - coalesce_window,
+                                                          now, fits):
+                    counts["coalesced"] += 1
+                    continue
+                rows.append((number, message, now, now, now, int(priority), tag))
+            self.conn.executemany(
+                "INSERT INTO outbox (number, message, created, next_attempt, updated, priority, tag) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return counts
+
+    def _coalesce(self, number: str, message: str, priority: SMSPriority, tag: Optional[str], since: float,
+                  now: float, fits: Optional[Callable[[str], bool]]) -> bool:
+        """
+        Appends a message to the newest matching message waiting for the same number.
+        Must be called inside a transaction.
+
+        :return: True if the message was merged
+        """
+        row = self.conn.execute(
+            "SELECT id, message FROM outbox WHERE number = ? AND state = 'pending' AND attempts = 0 "
+            "AND priority = ? AND tag IS ? AND created >= ? ORDER BY id DESC LIMIT 1",
+            (number, int(priority), tag, since)).fetchone()
+        if row is None:
+            return False
+        id, queued = row
+        if message in queued.split("\n\n"):      # Already part of the combined message
+            return True
+        combined = f"{queued}\n\n{message}"
+        if fits is not None and not fits(combined):
+            return False
+        self.conn.execute("UPDATE outbox SET message = ?, updated = ? WHERE id = ?", (combined, now, id))
+        return True
+
+    def claim_next(self, fits: Optional[Callable[[str], bool]] = None) -> Optional[SMSMessage]:
+        """
+        Takes the most urgent message that is due and marks it as being sent.
+        Urgency is the priority class minus one class per aging_time seconds waited, but no higher than
+        RESOLUTION for anything that is not CRITICAL. Ties go to the oldest.
+
+        If it is an alert (CRITICAL or RESOLUTION), the other alerts due for the same number are claimed
+        with it and sent as one SMS, oldest first, e.g. a temperature alert and a power flap.
+        They stay separate rows until they are sent, so superseding one topic still cancels only
+        that topic's text.
+
+        :param fits: Returns True if a combined text is short enough to send, None merges without limit
+        :return: The message or None if nothing is due
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT id, number, message, attempts, priority, tag, created FROM outbox "
+                "WHERE state = 'pending' AND next_attempt <= ? "
+                "ORDER BY CASE WHEN priority = ? THEN priority ELSE MAX(priority - (? - created) / ?, ?) END, id "
+                "LIMIT 1", (now, int(SMSPriority.CRITICAL), now, self.aging_time, int(SMSPriority.RESOLUTION))).fetchone()
+            if row is None:
+                return None
+            id, number, message, attempts, priority, tag, created = row
+            parts = [(id, message)]
+            if priority in MERGED_CLASSES:
+                # Same attempts so a merged SMS that failed is retried, and merged again, together
+                others = self.conn.execute(
+                    f"SELECT id, message FROM outbox WHERE state = 'pending' AND next_attempt <= ? AND number = ? "
+                    f"AND attempts = ? AND id != ? AND priority IN ({', '.join('?' * len(MERGED_CLASSES))}) "
+                    f"ORDER BY id", (now, number, attempts, id, *MERGED_CLASSES)).fetchall()
+                for other in others:
+                    combined = sorted(parts + [other])
+                    if fits is None or fits("\n\n".join(text for _, text in combined)):
+                        parts = combined
+            ids = [part_id for part_id, _ in parts]
+            self.conn.execute(f"UPDATE outbox SET state = 'sending', updated = ? WHERE id IN ({', '.join('?' * len(ids))})",
+                              (now, *ids))
+        return SMSMessage(number, "\n\n".join(text for _, text in parts), id=id, attempts=attempts,
+                          priority=SMSPriority(priority), tag=tag, created=created,
+                          merged_ids=tuple(part_id for part_id in ids if part_id != id))
+
+    @staticmethod
+    def row_ids(sms: SMSMessage) -> str:
+        """SQL list of the rows sent in a claimed message, ids are ints so they are safe to inline"""
+        return ", ".join(str(int(id)) for id in (sms.id, *sms.merged_ids))
+
+    def mark_sent(self, sms: SMSMessage) -> None:
+        """Marks a claimed message as sent"""
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE outbox SET state = 'sent', updated = ? WHERE id IN ({self.row_ids(sms)})",
+                              (time.time(),))
+
+    def mark_failed(self, sms: SMSMessage, error: str = "") -> bool:
+        """
+        Records a failed attempt, schedules a retry with exponential backoff or
+        moves the message to the dead letters after max_attempts.
+
+        :return: True if the message will be retried
+        """
+        now = time.time()
+        attempts = sms.attempts + 1
+        if attempts >= self.max_attempts:
+            state, next_attempt = 'dead', now
+        else:
+            state = 'pending'
+            next_attempt = now + min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE outbox SET state = ?, attempts = ?, next_attempt = ?, updated = ?, last_error = ? "
+                f"WHERE id IN ({self.row_ids(sms)})", (state, attempts, next_attempt, now, error))
+        return state == 'pending'
+
+    def release(self, sms: SMSMessage) -> None:
+        """Puts a claimed message back without counting an attempt, e.g. when the network is lost"""
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE outbox SET state = 'pending', updated = ? WHERE id IN ({self.row_ids(sms)})",
+                              (time.time(),))
+
+    def pending_count(self) -> int:
+        """Returns the number of messages waiting to be sent"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE state IN ('pending', 'sending')").fetchone()[0]
+
+    def oldest_pending(self) -> Optional[float]:
+        """Returns the time the oldest message still waiting was queued or None if there is none"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT MIN(created) FROM outbox WHERE state IN ('pending', 'sending')").fetchone()[0]
+
+    def next_due(self) -> Optional[float]:
+        """Returns the time the next pending message is due or None if there is none"""
+        with self.lock:
+            return self.conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE state = 'pending'").fetchone()[0]
+
+    def dead_count(self) -> int:
+        """Returns the number of messages that could not be sent and are not pruned yet"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE state = 'dead'").fetchone()[0]
+
+    def dead_letters(self, limit: int = 50) -> List[dict]:
+        """Returns the most recent messages that could not be sent"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT number, message, attempts, updated, last_error FROM outbox WHERE state = 'dead' "
+                "ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [{"number": number, "message": message, "attempts": attempts, "time": updated, "error": error}
+                for number, message, attempts, updated, error in rows]
+
+    def prune(self) -> None:
+        """Deletes sent, dead and cancelled messages older than keep_sent to bound the database size"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE state IN ('sent', 'dead', 'cancelled') AND updated < ?",
+                              (time.time() - self.keep_sent,))
+
+    def close(self) -> None:
+        """Closes the database"""
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    outbox = SMSOutbox(file_path="outbox_test.db")
+    outbox.enqueue([("+10000000000", f"Report {i}") for i in range(500)], SMSPriority.REPORT)
+    outbox.enqueue([("+10000000000", "High temperature")], SMSPriority.CRITICAL, tag="temperature")
+    outbox.enqueue([("+10000000000", "Alert Resolved")], SMSPriority.RESOLUTION, tag="temperature",
+                   supersedes=["temperature"])
+    print(f"Pending: {outbox.pending_count()}")
+    sms = outbox.claim_next()
+    print(f"Claimed: {sms.id} {sms.message}")
+    outbox.mark_failed(sms, "test")
+    print(f"Next due in {outbox.next_due() - time.time():.1f}s")
+    outbox.close()
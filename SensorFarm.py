@@ -0,0 +1,139 @@
+import os
+import errno
+import random
+import shutil
+import time
+import argparse
+import multiprocessing
+from typing import Dict, Optional, Tuple
+
+
+class SensorFarm(multiprocessing.Process):
+    """
+    Builds a synthetic w1 sysfs tree with many DS18B20 sensors so the read path can be
+    benchmarked without hardware. Pass farm.root to TemperatureSensor(sensor_dir=...).
+
+    Each sensor is a 28-<serial> folder whose 'w1_slave' is a FIFO: a read blocks until the
+    farm answers conversion_delay seconds after the file was opened, like the kernel driver
+    waiting for a conversion. Answers can fail the CRC, return the 85 C power-on value, and
+    sensor folders can disappear for a while as if the sensor dropped off the bus.
+    Runs in its own process so serving hundreds of FIFOs does not compete with the reader for the GIL.
+    """
+    def __init__(self, root: str, count: int = 100, conversion_delay: float = 0.75, crc_error_rate: float = 0.0,
+                 power_on_rate: float = 0.0, disappear_rate: float = 0.0, gone_time: float = 30.0,
+                 tick: float = 0.01, seed: Optional[int] = None):
+        super(SensorFarm, self).__init__(name="SensorFarm", daemon=True)
+        self.root = root
+        self.conversion_delay = conversion_delay    # Seconds between opening w1_slave and the answer
+        self.crc_error_rate = crc_error_rate        # Probability of a read with crc=.. NO
+        self.power_on_rate = power_on_rate          # Probability of a read returning the 85 C power-on value
+        self.disappear_rate = disappear_rate        # Probability per second of a sensor folder disappearing
+        self.gone_time = gone_time                  # Seconds a disappeared folder stays away
+        self.tick = tick                            # Seconds between checks for waiting readers
+        self.end_event = multiprocessing.Event()
+        self.random = random.Random(seed)
+
+        self.serials = [f"{0x0316a2790000 + i * 0x1f3:012x}" for i in range(count)]
+        self.temperatures: Dict[str, float] = {serial: self.random.uniform(18, 30) for serial in self.serials}
+        self.build()
+
+    def build(self) -> None:
+        """Creates the device folders with a FIFO for each w1_slave"""
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root)
+        for serial in self.serials:
+            folder = os.path.join(self.root, f"28-{serial}")
+            os.makedirs(folder)
+            os.mkfifo(os.path.join(folder, "w1_slave"))
+
+    def w1_slave(self, serial: str) -> bytes:
+        """Returns the two lines the kernel would, the temperature takes a small random walk"""
+        temperature = self.temperatures[serial] = self.temperatures[serial] + self.random.uniform(-0.05, 0.05)
+        millidegrees = int(temperature * 1000)
+        crc = "YES"
+        if self.random.random() < self.power_on_rate:
+            millidegrees = 85000
+        if self.random.random() < self.crc_error_rate:
+            crc, millidegrees = "NO", self.random.choice((0, -62, 127937))
+        raw = int(millidegrees / 62.5) & 0xFFFF
+        data = f"{raw & 0xFF:02x} {raw >> 8:02x} 4b 46 7f ff 0c 10 1c"
+        return f"{data} : crc=1c {crc}\n{data} t={millidegrees}\n".encode()
+
+    def run(self) -> None:
+        """Answers readers of the FIFOs and makes sensors disappear and come back"""
+        answering: Dict[str, Tuple[int, float]] = {}    # Serial -> (write end, time to answer)
+        gone: Dict[str, float] = {}                     # Serial -> time it comes back
+        while not self.end_event.is_set():
+            now = time.monotonic()
+            for serial in self.serials:
+                if serial in answering or serial in gone:
+                    continue
+                try:    # Only succeeds while a reader is blocked opening the FIFO
+                    fd = os.open(os.path.join(self.root, f"28-{serial}", "w1_slave"), os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as err:
+                    if err.errno not in (errno.ENXIO, errno.ENOENT):
+                        raise
+                    continue
+                answering[serial] = (fd, now + self.conversion_delay)
+
+            for serial, (fd, due) in list(answering.items()):
+                if now >= due:
+                    try:
+                        os.write(fd, self.w1_slave(serial))
+                    except OSError:
+                        pass        # Reader gave up
+                    os.close(fd)
+                    del answering[serial]
+
+            if self.disappear_rate:
+                for serial in self.serials:
+                    folder = os.path.join(self.root, f"28-{serial}")
+                    if serial in gone:
+                        if now >= gone[serial]:
+                            os.rename(os.path.join(self.root, f".gone-{serial}"), folder)
+                            del gone[serial]
+                    elif serial not in answering and self.random.random() < self.disappear_rate * self.tick:
+                        os.rename(folder, os.path.join(self.root, f".gone-{serial}"))
+                        gone[serial] = now + self.gone_time
+            time.sleep(self.tick)
+
+        for fd, _ in answering.values():
+            os.close(fd)
+
+    def stop(self) -> None:
+        """Stops answering and removes the tree, readers still waiting get an empty file"""
+        self.end_event.set()
+        self.join()
+        # Move the tree away so no new reader can open a FIFO, then release the ones already waiting
+        removed = f"{self.root}.removed"
+        shutil.rmtree(removed, ignore_errors=True)
+        os.rename(self.root, removed)
+        deadline = time.monotonic() + 0.2
+        while time.monotonic() < deadline:
+            for name in os.listdir(removed):
+                try:
+                    os.close(os.open(os.path.join(removed, name, "w1_slave"), os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            time.sleep(self.tick)
+        shutil.rmtree(removed, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic w1 sysfs tree of DS18B20 sensors")
+    parser.add_argument("--root", default="/tmp/w1_farm", help="Folder to build the tree in")
+    parser.add_argument("--count", type=int, default=100, help="Number of sensors")
+    parser.add_argument("--delay", type=float, default=0.75, help="Conversion delay in seconds")
+    parser.add_argument("--crc-error-rate", type=float, default=0.0, help="Probability of a CRC failure")
+    parser.add_argument("--power-on-rate", type=float, default=0.0, help="Probability of an 85 C reading")
+    parser.add_argument("--disappear-rate", type=float, default=0.0, help="Probability per second of a sensor vanishing")
+    args = parser.parse_args()
+
+    farm = SensorFarm(args.root, args.count, args.delay, args.crc_error_rate, args.power_on_rate, args.disappear_rate)
+    farm.start()
+    print(f"Serving {args.count} sensors in {args.root}, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        farm.stop()
@@ -0,0 +1,96 @@
+import time
+from typing import Dict, List, Optional
+
+
+class SensorScheduler:
+    """
+    Decides when each sensor is read next, so sensors close to their trigger or heating up
+    are sampled often and cold, stable sensors are left alone most of the time.
+
+    After each reading the interval is the time the sensor would need to climb half of its
+    headroom to the trigger at its current rate of rise, and the rate is never assumed to be
+    lower than assumed_rate. The result is kept between min_interval and max_interval:
+        headroom 17 C, stable      -> max_interval
+        headroom 0.2 C             -> min_interval
+        headroom 5 C, rising 0.5 C/s -> 5 s
+    A sensor above its trigger, or that failed to read, is read again after min_interval.
+    """
+    def __init__(self, min_interval: float = 2.0, max_interval: float = 30.0, assumed_rate: float = 0.05,
+                 smoothing: float = 0.5):
+        self.min_interval = min_interval    # Seconds, fastest sampling for a sensor at or near its trigger
+        self.max_interval = max_interval    # Seconds, slowest sampling for a cold stable sensor
+        self.assumed_rate = assumed_rate    # C/s, lowest rate of rise used for the estimate
+        self.smoothing = smoothing          # Weight of the newest slope in the averaged rate, 0-1
+        self.next_read: Dict[str, float] = {}   # Serial -> monotonic time the sensor is due
+        self.last: Dict[str, tuple] = {}        # Serial -> (time, temperature) of the last reading
+        self.rates: Dict[str, float] = {}       # Serial -> averaged rate of change in C/s
+
+    def set_bounds(self, min_interval: float, max_interval: float) -> None:
+        """
+        Changes the sampling bounds, e.g. after the config is reloaded.
+
+        :param min_interval: Fastest sampling in seconds
+        :param max_interval: Slowest sampling in seconds, raised to min_interval if lower
+        """
+        self.min_interval = max(float(min_interval), 0.1)
+        self.max_interval = max(float(max_interval), self.min_interval)
+
+    def due(self, serials: List[str], now: Optional[float] = None) -> List[str]:
+        """
+        Returns the sensors that should be read now, a sensor never seen before is due right away.
+
+        :param serials: All known sensor serials
+        :param now: Monotonic time, defaults to now
+        """
+        now = time.monotonic() if now is None else now
+        return [serial for serial in serials if self.next_read.get(serial, 0) <= now]
+
+    def next_due(self, serials: List[str]) -> float:
+        """Returns the monotonic time the next of these sensors is due, now if one never was read"""
+        return min((self.next_read.get(serial, 0) for serial in serials), default=time.monotonic() + self.max_interval)
+
+    def update(self, serial: str, temperature: Optional[float], trigger: Optional[float],
+               now: Optional[float] = None) -> float:
+        """
+        Records a reading of a sensor and schedules its next read.
+
+        :param serial: Sensor serial
+        :param temperature: The reading, None if the read failed
+        :param trigger: Trigger of the sensor, None if it has no config
+        :param now: Monotonic time of the reading, defaults to now
+        :return: Seconds until the sensor is read again
+        """
+        now = time.monotonic() if now is None else now
+        if temperature is None:
+            interval = self.min_interval
+        else:
+            previous = self.last.get(serial)
+            if previous is not None and now > previous[0]:
+                slope = (temperature - previous[1]) / (now - previous[0])
+                self.rates[serial] = self.smoothing * slope + (1 - self.smoothing) * self.rates.get(serial, slope)
+            self.last[serial] = (now, temperature)
+            interval = self.interval(temperature, trigger, self.rates.get(serial, 0.0))
+        self.next_read[serial] = now + interval
+        return interval
+
+    def interval(self, temperature: float, trigger: Optional[float], rate: float) -> float:
+        """
+        Seconds until the next read of a sensor.
+
+        :param temperature: Latest reading
+        :param trigger: Trigger of the sensor, None samples at max_interval
+        :param rate: Rate of change in C/s, falling sensors use assumed_rate
+        """
+        if trigger is None:
+            return self.max_interval
+        headroom = trigger - temperature
+        if headroom <= 0:
+            return self.min_interval
+        interval = headroom / (2 * max(rate, self.assumed_rate))
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def forget(self, serial: str) -> None:
+        """Drops the history of a removed sensor"""
+        self.next_read.pop(serial, None)
+        self.last.pop(serial, None)
+        self.rates.pop(serial, None)
@@ -1,11 +1,52 @@
 import os
 import glob
+import math
 import time
+import statistics
+import threading
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Optional
 from systemd import journal
 
 
 SENSOR_DIR = '/sys/bus/w1/devices/'
+RESOLUTIONS = (9, 10, 11, 12)     # Bits, conversion takes ~94, 188, 375 and 750 ms
+DEFAULT_RESOLUTION = 12           # DS18B20 power-on default
+REMOVAL_DELAY = 150               # Seconds a sensor folder must stay gone before the sensor is dropped
+SENTINELS = (85.0, -127.0)        # Power-on value read before any conversion, and a sensor that is not answering
+SENTINEL_MARGIN = 5.0             # An 85 C reading is believed if the recent readings are within this many degrees
+SPIKE_LIMIT = 5.0                 # Degrees away from the recent median that a reading must be confirmed by a second read
+HISTORY_SIZE = 5                  # Accepted readings kept per sensor for the median
+
+
+class CRCError(ValueError):
+    """The sensor answered but the CRC of the scratchpad did not match"""
+
+
+class SensorStats:
+    """ Outcomes of the reads of one sensor """
+    def __init__(self):
+        self.reads = 0                  # Accepted readings
+        self.crc_errors = 0
+        self.sentinels = 0              # 85 C / -127 C readings rejected
+        self.spikes = 0                 # Readings far from the median that were not confirmed
+        self.read_errors = 0            # Missing file, unreadable or invalid contents
+        self.timeouts = 0               # Not read or no answer before the cycle's deadline
+        self.consecutive_failures = 0   # Cycles without an accepted reading since the last one
+        self.last_error: Optional[str] = None
+        self.last_error_time: Optional[float] = None
+
+    def record_error(self, kind: str, error: str) -> None:
+        """Counts one rejected or failed read, kind is the name of the counter"""
+        setattr(self, kind, getattr(self, kind) + 1)
+        self.last_error = error
+        self.last_error_time = time.time()
+
+    def to_dict(self) -> dict:
+        """Returns the stats as plain data for JSON"""
+        return dict(vars(self))
 
 class TemperatureSensor:
     """A class to read 1-wire (w1) sensor data DS18B20 from sysfs.
@@ -18,13 +59,32 @@ class TemperatureSensor:
         /sys/bus/w1/devices
     Each device will appear as X number of files:
 
-    Support is provided through the sysfs 'w1_slave file'.
+    Support is provided through the sysfs 'temperature' file, or the 'w1_slave' file on older kernels.
     This module will not work if w1-gpio and w1-therm are not loaded beforehand
+
+    If the bus master has 'therm_bulk_read' (kernel 5.10+) every sensor on the bus converts at once
+    and the values are then read without waiting again. Otherwise sensors are read in parallel:
+    w1_therm releases the bus while a sensor converts, so the ~750 ms conversions overlap.
+    Either way a full read takes about one conversion time.
     """
-    def __init__(self, debug=True):
+    def __init__(self, debug=True, read_timeout: float = 3.0, max_workers: int = 32, sensor_dir: str = SENSOR_DIR,
+                 retries: int = 2):
+        self.sensor_dir = os.path.join(sensor_dir, '')  # Root of the w1 device folders, e.g. a SensorFarm tree
         self.sensor_serials = self.discover_sensors()
-        self.warning = False       # Error flag when reading sensors 
         self.debug = debug
+        self.read_timeout = read_timeout    # Seconds to wait for one batch of max_workers sensors
+        self.max_workers = max_workers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="w1-reader")
+        self.missed: set[str] = set()       # Serials not read before last cycle's deadline, submitted first
+        self.pending: dict[str, Future] = {}    # Serial -> read still running after its timeout, i.e. a hung sensor
+        self.bulk_read_files = self.discover_bulk_read()    # 'therm_bulk_read' of each bus master, empty if unsupported
+        self.resolutions: dict[str, int] = {}   # Serial -> resolution last written to the sensor
+        self.wanted_resolutions: dict[str, int] = {}    # Serial -> resolution from the config, see apply_resolutions()
+        self.missing_since: dict[str, float] = {}   # Serial -> time its folder disappeared, see scan_devices()
+        self.retries = retries      # Extra reads of a sensor in one cycle after a failed or rejected read
+        self.history: dict[str, deque] = {}     # Serial -> last accepted readings, see read_filtered()
+        self.stats: dict[str, SensorStats] = {}
+        self.stats_lock = threading.Lock()      # Reads run in the pool, get_stats() in the web thread
         
     def discover_sensors(self):
         """
@@ -34,12 +94,141 @@ class TemperatureSensor:
         Returns: List of sensor serials extracted from the folder name
         """
         serials = []
-        sensor_folders = glob.glob(SENSOR_DIR + '28-*')   # Gives a list of temp sensor folders
+        sensor_folders = glob.glob(self.sensor_dir + '28-*')   # Gives a list of temp sensor folders
         for folder in sensor_folders:                 
-            _, _, serial = folder.partition('28-')
+            _, _, serial = os.path.basename(folder).partition('28-')
             serials.append(serial)
         return serials
         
+    def scan_devices(self) -> tuple:
+        """
+        Compares the device folders with the known sensors and updates sensor_serials incrementally.
+        A new folder is added right away. A folder that disappears is only dropped after REMOVAL_DELAY
+        so a flaky sensor that drops off the bus for a few searches is not removed and added again,
+        it is not read while its folder is gone.
+        sysfs does not send inotify events when devices come and go, listing one
+        directory is a single cheap call so this runs on every monitor cycle.
+        
+        Returns: (added, removed) lists of serials, both empty if nothing changed
+        """
+        try:
+            present = {name[3:] for name in os.listdir(self.sensor_dir) if name.startswith('28-')}
+        except OSError as err:
+            self.log(f"Could not list sensors: {err}")
+            return [], []
+        
+        now = time.monotonic()
+        added = sorted(serial for serial in present if serial not in self.sensor_serials)
+        removed = []
+        for serial in self.sensor_serials:
+            if serial in present:
+                if self.missing_since.pop(serial, None) is not None:
+                    self.log(f"Sensor '{serial}' is back")
+                    # It powered up at 12 bits, the resolution attribute only sets the scratchpad
+                    self.resolutions.pop(serial, None)
+                    if serial in self.wanted_resolutions:
+                        self.apply_resolutions({serial: self.wanted_resolutions[serial]})
+            elif serial not in self.missing_since:
+                self.missing_since[serial] = now
+                self.log(f"Sensor '{serial}' disappeared")
+            elif now - self.missing_since[serial] >= REMOVAL_DELAY:
+                removed.append(serial)
+        
+        for serial in removed:
+            del self.missing_since[serial]
+            self.resolutions.pop(serial, None)
+            self.history.pop(serial, None)
+            with self.stats_lock:
+                self.stats.pop(serial, None)
+        if added or removed:
+            self.sensor_serials = [serial for serial in self.sensor_serials if serial not in removed] + added
+            self.log(f"Sensors added: {added}, removed: {removed}")
+        return added, removed
+    
+    def apply_resolutions(self, resolutions: dict) -> None:
+        """
+        Sets the resolution of each sensor through the w1_therm 'resolution' attribute.
+        Lower resolutions convert much faster, at 9 bits a reading is still precise to 0.5 C.
+        Only writes sensors whose resolution changed or that were not set since discovery.
+        
+        :param resolutions: Dict of sensor serial and resolution in bits (9-12)
+        """
+        self.wanted_resolutions.update(resolutions)     # Applied again when a sensor comes back on the bus
+        for serial, bits in resolutions.items():
+            if serial not in self.sensor_serials or self.resolutions.get(serial) == bits:
+                continue
+            if bits not in RESOLUTIONS:
+                self.log(f"Invalid resolution {bits} for sensor '{serial}', keeping {DEFAULT_RESOLUTION} bits")
+                bits = DEFAULT_RESOLUTION
+            try:
+                with open(f'{self.sensor_dir}28-{serial}/resolution', "w") as f:
+                    f.write(f"{bits}\n")
+            except OSError as err:      # Kernels before 5.10 have no resolution attribute
+                self.log(f"Could not set resolution of sensor '{serial}': {err}")
+                continue
+            self.resolutions[serial] = bits
+            self.log(f"Sensor '{serial}' resolution set to {bits} bits")
+    
+    def discover_bulk_read(self) -> list:
+        """
+        Finds the bus masters that support simultaneous conversion of all their sensors.
+        
+        Returns: List of paths to the 'therm_bulk_read' files
+        """
+        files = glob.glob(self.sensor_dir + 'w1_bus_master*/therm_bulk_read')
+        if files:
+            self.log(f"Using bulk conversion on {len(files)} bus master(s)")
+        return files
+    
+    def bulk_convert(self) -> None:
+        """
+        Starts a conversion on every sensor of every bus master and waits until they are done,
+        after which each sensor's 'temperature' file returns its value without converting again.
+        Falls back to per-sensor conversions if the trigger cannot be written.
+        """
+        try:
+            for file in self.bulk_read_files:
+                with open(file, "w") as f:
+                    f.write("trigger\n")
+        except OSError as err:
+            self.log(f"Bulk conversion failed, reading sensors one by one: {err}")
+            self.bulk_read_files = []
+            return
+        
+        # Reads -1 while any sensor on the bus is still converting
+        deadline = time.monotonic() + self.read_timeout
+        pending = list(self.bulk_read_files)
+        while pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+            pending = [file for file in pending if self.bulk_read_status(file) == -1]
+    
+    @staticmethod
+    def bulk_read_status(file: str) -> int:
+        """Returns the value of a 'therm_bulk_read' file: -1 converting, 1 values ready, 0 idle"""
+        try:
+            with open(file, "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+    
+    def read_sensor(self, serial: str) -> float:
+        """Reads the compact 'temperature' file (millidegrees C), or 'w1_slave' if the kernel does not have it.
+
+        Will raise OSError if the file fails to read, e.g. on a CRC error.
+        Will raise ValueError on invalid contents.
+        On success returns the temperature in degress C (float).
+        """
+        file = f'{self.sensor_dir}28-{serial}/temperature'
+        try:
+            with open(file, "r") as f:
+                data = f.read().strip()
+        except FileNotFoundError:
+            return self.read_temp(serial)
+        try:
+            return round(int(data) / 1000.0, 1)
+        except ValueError:
+            raise ValueError(f"Invalid temperature data in {file}: {data!r}")
+        
     def read_temp(self, serial: str) -> float:
         """Reads and parses the 'w1_slave' sensor file.
 
@@ -52,15 +241,17 @@ class TemperatureSensor:
         Centigrade after t=.
 
         Will raise OSError if the file fails to open or read.
-        Will raise ValueError on invalid contents or bad CRC.
+        Will raise ValueError on invalid contents, CRCError on a bad CRC.
         On success returns the temperature in degress C (float).
         """
-        file = f'{SENSOR_DIR}28-'+serial+'/w1_slave'  # Converting the serial to the actual path
+        file = f'{self.sensor_dir}28-'+serial+'/w1_slave'  # Converting the serial to the actual path
         try:
             with open(file, "r") as f:
                 lines = f.readlines()
                 if len(lines) != 2:
                     raise ValueError(f"Not two lines in {file}")
+                if not lines[0].strip().endswith("YES"):    # The t= value of a failed CRC is garbage
+                    raise CRCError(f"CRC check failed: {lines[0].strip()}")
                 # Parse temperature from lines[1]
                 temp_data = lines[1].split("t=")
                 if len(temp_data) == 2:
@@ -70,9 +261,59 @@ class TemperatureSensor:
                     raise ValueError("Invalid temperature data format.")
         except FileNotFoundError:
             raise ValueError(f"Sensor file not found: {file}")
+        except CRCError:
+            raise
         except Exception as e:
             raise ValueError(f"Error reading sensor {serial}: {e}")
 
+    def read_filtered(self, serial: str) -> float:
+        """
+        Reads a sensor and only returns a reading that passes the checks, reading again up to retries times:
+            - the CRC must match ('w1_slave'), the kernel fails the read for the 'temperature' file
+            - 85 C (power-on value) and -127 C (no answer) are rejected, unless the sensor
+              really was close to 85 C
+            - a reading more than SPIKE_LIMIT from the median of the recent readings is only
+              accepted when the next read confirms it, a lone spike is dropped
+        Every failure is counted in the sensor's SensorStats.
+
+        Will raise the last error if no reading passes.
+        :param serial: Sensor serial
+        """
+        history = self.history.setdefault(serial, deque(maxlen=HISTORY_SIZE))
+        median = statistics.median(history) if history else None
+        suspect = None      # Reading far from the median waiting to be confirmed
+        error = None
+        for _ in range(self.retries + 1):
+            try:
+                temp_c = self.read_sensor(serial)
+            except CRCError as err:
+                error, kind = err, "crc_errors"
+            except (OSError, ValueError) as err:
+                error, kind = err, "read_errors"
+            else:
+                if temp_c in SENTINELS and (median is None or abs(temp_c - median) > SENTINEL_MARGIN):
+                    error, kind = ValueError(f"Rejected {temp_c} C sentinel value"), "sentinels"
+                elif median is not None and abs(temp_c - median) > SPIKE_LIMIT and \
+                        (suspect is None or abs(temp_c - suspect) > SPIKE_LIMIT):
+                    suspect = temp_c
+                    error, kind = ValueError(f"Unconfirmed jump to {temp_c} C from {median} C"), "spikes"
+                else:
+                    history.append(temp_c)
+                    with self.stats_lock:
+                        stats = self.stats.setdefault(serial, SensorStats())
+                        stats.reads += 1
+                        stats.consecutive_failures = 0
+                    return temp_c
+            with self.stats_lock:
+                self.stats.setdefault(serial, SensorStats()).record_error(kind, str(error) or error.__class__.__name__)
+        with self.stats_lock:
+            self.stats[serial].consecutive_failures += 1
+        raise error
+    
+    def get_stats(self) -> dict:
+        """Returns the read statistics of every sensor by serial"""
+        with self.stats_lock:
+            return {serial: stats.to_dict() for serial, stats in self.stats.items()}
                          
     def log(self, message: str) -> None:
         """
@@ -83,21 +324,60 @@ class TemperatureSensor:
         if self.debug:
             journal.send(message)
             
-    def get_readings(self) -> dict:
+    def get_readings(self, serials: list = None) -> dict:
         """Returns a dictionary of sensor serial and their readings.
 
         Example: [{"xxxxxxxxx":25.23,...}]
-        If there is a read error, will change warning to True.
+        Up to max_workers sensors are read at once and the cycle waits read_timeout per batch.
+        A sensor that does not answer in time is left out of this cycle and is not read again
+        until its hung read returns. Sensors still queued at the deadline are cancelled and
+        submitted first next cycle, so the same sensors are not always the ones left out.
+        
+        :param serials: Only read these sensors, defaults to all known sensors
         """
+        if serials is None:
+            serials = self.sensor_serials
+        else:
+            known = set(self.sensor_serials)
+            serials = [serial for serial in serials if serial in known]
+        if not serials:
+            return {}
+        if self.bulk_read_files:
+            self.bulk_convert()
+        futures = {}
+        serials = sorted(serials, key=lambda serial: serial not in self.missed)     # Stable, missed ones first
+        for serial in serials:
+            if serial in self.missing_since:        # Folder is gone, waiting to see if it comes back
+                continue
+            hung = self.pending.get(serial)
+            if hung is not None and not hung.done():
+                self.log(f"Error reading sensor with serial '{serial}': previous read has not returned")
+                continue
+            futures[serial] = self.pool.submit(self.read_filtered, serial)
+        timeout = self.read_timeout * math.ceil(len(futures) / self.max_workers)
+        wait(futures.values(), timeout=timeout)
+        
         readings = {}
-        for serial in self.sensor_serials:
+        self.missed = set()
+        for serial, future in futures.items():
+            if not future.done():
+                self.missed.add(serial)
+                if future.cancel():     # Still queued behind other sensors, nothing is stuck
+                    error = f"Not read within {timeout:.1f}s"
+                else:
+                    self.pending[serial] = future
+                    error = f"No answer within {timeout:.1f}s"
+                with self.stats_lock:
+                    self.stats.setdefault(serial, SensorStats()).record_error("timeouts", error)
+                self.log(f"Error reading sensor with serial '{serial}': {error}")
+                continue
+            self.pending.pop(serial, None)
             try:
-                temp_c = self.read_temp(serial)
+                temp_c = future.result()
             except (OSError, ValueError) as err:
                 # SysFS w1_slave invalid format or failed CRC.
                 error = str(err) if str(err) else str(err.__class__.__name__)
                 message = f"Error reading sensor with serial '{serial}': {error}"
-                self.warning = True
                 self.log(message)
                 self.log(traceback.format_exc())
             else:
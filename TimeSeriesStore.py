@@ -0,0 +1,198 @@
+import os
+import mmap
+import time
+import struct
+import threading
+from typing import Dict, List, Optional, Tuple
+
+HEADER = struct.Struct("<4sII")      # Magic, capacity, records written in total
+RECORD = struct.Struct("<dfff")      # Unix time, min, max, mean, raw samples have min = max = mean
+MAGIC = b"TSR1"
+TIERS = (                            # Name, bucket seconds (0 = every sample), records kept
+    ("raw", 0, 8640),                # ~12 h at one sample every 5 s
+    ("1m", 60, 10080),               # 7 days
+    ("1h", 3600, 8760),              # 1 year
+)
+
+
+class RingFile:
+    """
+    A fixed size file of RECORDs used as a ring buffer through mmap, the oldest record is
+    overwritten once it is full so the file never grows. Records are appended in time order.
+    """
+    def __init__(self, path: str, capacity: int):
+        size = HEADER.size + capacity * RECORD.size
+        new = not os.path.exists(path) or os.path.getsize(path) != size
+        self.file = open(path, "w+b" if new else "r+b")
+        if new:     # Also recreates a ring whose capacity was changed
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        magic, stored_capacity, self.written = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or stored_capacity != capacity:
+            self.written = 0
+            HEADER.pack_into(self.map, 0, MAGIC, capacity, 0)
+        self.capacity = capacity
+
+    def __len__(self) -> int:
+        return min(self.written, self.capacity)
+
+    def append(self, record: tuple) -> None:
+        """Writes a record over the oldest one if the ring is full"""
+        RECORD.pack_into(self.map, HEADER.size + (self.written % self.capacity) * RECORD.size, *record)
+        self.written += 1
+        HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.written)
+
+    def time_at(self, index: int) -> float:
+        """Time of the index-th oldest record"""
+        slot = (self.written - len(self) + index) % self.capacity
+        return struct.unpack_from("<d", self.map, HEADER.size + slot * RECORD.size)[0]
+
+    def bisect(self, timestamp: float) -> int:
+        """Index of the oldest record at or after timestamp"""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.time_at(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read(self, start: int, end: int) -> List[tuple]:
+        """Records start to end (oldest first), read as at most two slices of the map"""
+        if start >= end:
+            return []
+        first = (self.written - len(self) + start) % self.capacity
+        count = end - start
+        slices = [(first, min(count, self.capacity - first))]
+        if slices[0][1] < count:
+            slices.append((0, count - slices[0][1]))
+        records = []
+        for slot, n in slices:
+            offset = HEADER.size + slot * RECORD.size
+            records.extend(RECORD.iter_unpack(self.map[offset:offset + n * RECORD.size]))
+        return records
+
+    def flush(self) -> None:
+        self.map.flush()
+
+    def close(self) -> None:
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class TimeSeriesStore:
+    """
+    Keeps the temperature history of every sensor in fixed size ring files, so disk usage is
+    bounded (about 550 KB per sensor with the default TIERS) and nothing is ever rewritten as a whole.
+
+    Each sensor has one file per tier: the raw samples, and min/max/mean rollups per minute and
+    per hour computed while the samples come in. A query reads only the tier that fits the
+    requested span, e.g. the last 24 h of a sensor is 1440 one-minute records.
+    The minute and hour in progress are kept in memory and written when they are over.
+    Writes go to the page cache through mmap and are flushed every flush_interval seconds
+    to limit SD card writes.
+    """
+    def __init__(self, folder: str = "Config/series", tiers: tuple = TIERS, flush_interval: float = 60.0):
+        self.folder = folder
+        self.tiers = tiers
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.rings: Dict[Tuple[str, str], RingFile] = {}        # (serial, tier name) -> ring
+        self.buckets: Dict[Tuple[str, str], list] = {}          # (serial, tier name) -> [start, min, max, sum, count]
+        self.lock = threading.Lock()        # Written by the monitor thread, queried by the web thread
+        os.makedirs(folder, exist_ok=True)
+
+    def ring(self, serial: str, tier: str) -> RingFile:
+        """Opens the ring file of a sensor's tier, creating it on first use"""
+        ring = self.rings.get((serial, tier))
+        if ring is None:
+            capacity = next(capacity for name, _, capacity in self.tiers if name == tier)
+            ring = self.rings[(serial, tier)] = RingFile(os.path.join(self.folder, f"{serial}.{tier}.ring"), capacity)
+        return ring
+
+    def existing_ring(self, serial: str, tier: str) -> Optional[RingFile]:
+        """Opens the ring file of a sensor's tier only if it was already stored, None otherwise"""
+        ring = self.rings.get((serial, tier))
+        if ring is None and os.path.exists(os.path.join(self.folder, f"{serial}.{tier}.ring")):
+            ring = self.ring(serial, tier)
+        return ring
+
+    def append(self, readings: dict, timestamp: Optional[float] = None) -> None:
+        """
+        Stores one reading of each sensor and updates the rollups.
+
+        :param readings: Dict of sensor serial and its temperature
+        :param timestamp: Unix time of the readings, defaults to now
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            for serial, temperature in readings.items():
+                for name, seconds, _ in self.tiers:
+                    if not seconds:
+                        self.ring(serial, name).append((timestamp, temperature, temperature, temperature))
+                        continue
+                    start = timestamp - timestamp % seconds
+                    bucket = self.buckets.get((serial, name))
+                    if bucket is not None and bucket[0] != start:     # Bucket is over
+                        self.ring(serial, name).append((bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4]))
+                        bucket = None
+                    if bucket is None:
+                        self.buckets[(serial, name)] = [start, temperature, temperature, temperature, 1]
+                    else:
+                        bucket[1] = min(bucket[1], temperature)
+                        bucket[2] = max(bucket[2], temperature)
+                        bucket[3] += temperature
+                        bucket[4] += 1
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def choose_tier(self, serial: str, start: float, end: float) -> str:
+        """
+        Picks the finest tier that has data back to start and does not return far more
+        points than a chart can show: raw up to 2 h, minutes up to 2 days, hours beyond.
+        """
+        span = end - start
+        wanted = "raw" if span <= 2 * 3600 else "1m" if span <= 2 * 86400 else "1h"
+        names = [name for name, _, _ in self.tiers]
+        for name in names[names.index(wanted):]:
+            ring = self.existing_ring(serial, name)
+            # A ring that is not full yet holds everything since the sensor was first stored,
+            # a coarser tier would not reach further back
+            if ring is None or len(ring) < ring.capacity or ring.time_at(0) <= start:
+                return name
+        return names[-1]
+
+    def query(self, serial: str, start: float, end: Optional[float] = None, tier: Optional[str] = None) -> dict:
+        """
+        Returns the history of a sensor between start and end.
+
+        :param serial: Sensor serial
+        :param start: Unix time of the oldest point
+        :param end: Unix time of the newest point, defaults to now
+        :param tier: 'raw', '1m' or '1h', chosen from the span if None
+        :return: {"tier", "points": [(time, min, max, mean), ...]} oldest first
+        """
+        end = time.time() if end is None else end
+        with self.lock:
+            tier = tier or self.choose_tier(serial, start, end)
+            ring = self.existing_ring(serial, tier)     # A query never creates files
+            points = [] if ring is None else ring.read(ring.bisect(start), ring.bisect(end + 1e-6))
+            bucket = self.buckets.get((serial, tier))
+            if bucket is not None and start <= bucket[0] <= end:    # Include the minute or hour in progress
+                points.append((bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4]))
+        return {"tier": tier, "points": points}
+
+    def flush(self) -> None:
+        """Writes the dirty pages of every ring to disk"""
+        for ring in self.rings.values():
+            ring.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """Flushes and closes every ring file"""
+        with self.lock:
+            for ring in self.rings.values():
+                ring.close()
+            self.rings.clear()
@@ -0,0 +1,55 @@
+"""
+Measures how TemperatureSensor.get_readings and the alert evaluation of the monitor loop
+scale with the number of sensors, on a synthetic w1 tree served by SensorFarm.
+
+    python bench_sensors.py --counts 10 50 100 200 --delay 0.75 --cycles 3
+"""
+import argparse
+import os
+import time
+from SensorFarm import SensorFarm
+from TemperatureSensor import TemperatureSensor
+from Config.Config import SensorRule, evaluate_thresholds
+
+
+def bench(count: int, args) -> None:
+    """Reads a farm of count sensors for a few cycles and prints the timings"""
+    root = os.path.join(args.root, f"farm_{count}")
+    farm = SensorFarm(root, count, args.delay, args.crc_error_rate, args.power_on_rate, args.disappear_rate, seed=1)
+    farm.start()
+    sensor = TemperatureSensor(debug=False, sensor_dir=root, max_workers=args.workers)
+    rules = {serial: SensorRule(serial, 25, 24, 12) for serial in farm.serials}
+    above_threshold: dict = {}
+
+    read_times, eval_times, read_counts = [], [], []
+    for _ in range(args.cycles):
+        sensor.scan_devices()
+        start = time.perf_counter()
+        readings = sensor.get_readings()
+        read_times.append(time.perf_counter() - start)
+        read_counts.append(len(readings))
+
+        start = time.perf_counter()
+        evaluate_thresholds(readings, rules, above_threshold)
+        eval_times.append(time.perf_counter() - start)
+    farm.stop()
+
+    print(f"{count:6d} sensors | read {min(read_times):6.2f}s min {max(read_times):6.2f}s max "
+          f"| {min(read_counts):4d}-{max(read_counts):4d} readings | evaluate {max(eval_times) * 1000:7.3f}ms "
+          f"| {len(above_threshold)} above threshold")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sensor reads against a synthetic w1 tree")
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 50, 100, 200], help="Sensor counts to measure")
+    parser.add_argument("--cycles", type=int, default=3, help="Monitor cycles per count")
+    parser.add_argument("--delay", type=float, default=0.75, help="Conversion delay in seconds")
+    parser.add_argument("--workers", type=int, default=32, help="Reader threads")
+    parser.add_argument("--crc-error-rate", type=float, default=0.0, help="Probability of a CRC failure")
+    parser.add_argument("--power-on-rate", type=float, default=0.0, help="Probability of an 85 C reading")
+    parser.add_argument("--disappear-rate", type=float, default=0.0, help="Probability per second of a sensor vanishing")
+    parser.add_argument("--root", default="/tmp/w1_bench", help="Folder to build the trees in")
+    args = parser.parse_args()
+
+    for count in args.counts:
+        bench(count, args)
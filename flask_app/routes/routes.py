@@ -3,6 +3,7 @@ from flask_app import app
 from monitor_instance import get_monitor
 from utils import file_utils
 from utils import utils
+from utils.downsample import lttb
 import sys
 import time
     
@@ -20,8 +21,9 @@ def settings():
 
 @app.route("/history")
 def history():
-    history = file_utils.get_history_data()
-    return render_template("history.html", history=history)
+    page = request.args.get('page', 1, type=int)
+    history, page, pages = file_utils.get_history_page(page)
+    return render_template("history.html", history=history, page=page, pages=pages)
 
 @app.route("/help")
 def help():
@@ -59,14 +61,54 @@ def insite_poll():
         sensors.append(item)
     return jsonify(sensors)
 
+@app.route("/get_modem_stats", methods=['GET'])
+def modem_stats():
+    monitor = get_monitor()
+    return jsonify(monitor.sms_thread.get_stats())
+
+@app.route("/get_sensor_stats", methods=['GET'])
+def sensor_stats():
+    monitor = get_monitor()
+    return jsonify(monitor.sensor.get_stats())
+
+@app.route("/api/series", methods=['GET'])
+def series():
+    """
+    History of the sensors for a time range, downsampled to at most 'points' points per sensor.
+    Query: sensor (repeatable, default all), start and end (unix time) or hours back from now (default 24), points (default 300)
+    """
+    monitor = get_monitor()
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - request.args.get('hours', 24, type=float) * 3600, type=float)
+    points = min(max(request.args.get('points', 300, type=int), 3), 2000)
+    rules = monitor.config.rules
+    # Only configured sensors, a serial is part of a file name in the series folder
+    serials = [serial for serial in request.args.getlist('sensor') or list(rules)
+               if serial in rules and utils.is_sensor_serial(serial)]
+    result = []
+    for serial in serials:
+        data = monitor.series.query(serial, start, end)
+        times = [point[0] for point in data["points"]]
+        means = [point[3] for point in data["points"]]
+        kept = lttb(times, means, points)
+        result.append({
+            "sensor": serial,
+            "name": rules[serial].name,
+            "tier": data["tier"],
+            "points": [[times[i], round(means[i], 2)] for i in kept]
+        })
+    return jsonify({"start": start, "end": end, "series": result})
+
 @app.route('/update_sensor', methods=['POST'])
 def update_sensor():
     sensor = request.form['sensor']
     name = request.form['name']
     trigger = request.form['trigger']
-    file_utils.update_sensor_data(sensor, name, trigger)
+    resolution = request.form.get('resolution')
+    file_utils.update_sensor_data(sensor, name, trigger, resolution)
     monitor = get_monitor()
     monitor.config.load_config()
+    monitor.apply_sensor_resolutions()
     return redirect(url_for('settings'))
 
 @app.route('/apply_trigger_all', methods=['POST'])
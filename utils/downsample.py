@@ -0,0 +1,51 @@
+"""
+Downsampling of time series for charts.
+Largest-Triangle-Three-Buckets keeps the points that shape the line (peaks, steps), unlike
+averaging or taking every n-th point, so a spike is still visible after downsampling a week.
+https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+"""
+import numpy as np
+
+
+def lttb(x, y, threshold: int) -> np.ndarray:
+    """
+    Selects threshold points of the series with Largest-Triangle-Three-Buckets.
+    The first and last points are always kept, the points in between are split in threshold - 2
+    buckets and from each bucket the point forming the largest triangle with the point kept from
+    the previous bucket and the average of the next bucket is kept.
+    The triangle areas of a whole bucket are computed at once with NumPy, only the walk
+    over the buckets is a Python loop since each choice depends on the previous one.
+
+    :param x: Times in increasing order
+    :param y: Values
+    :param threshold: Number of points to keep
+    :return: Indexes of the kept points, all indexes if there are not more than threshold points
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    count = len(x)
+    if threshold >= count:
+        return np.arange(count)
+    if threshold < 3:
+        return np.array([0, count - 1][:max(threshold, 0)], dtype=np.int64)
+
+    # Bucket i covers [edges[i], edges[i + 1]) of the points between the first and the last
+    edges = (np.arange(threshold - 1) * (count - 2) / (threshold - 2)).astype(np.int64) + 1
+    edges[-1] = count - 1
+    # Average of every bucket, plus the last point as the "next bucket" of the last bucket
+    sums_x, sums_y = np.add.reduceat(x[1:-1], edges[:-1] - 1), np.add.reduceat(y[1:-1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    avg_x = np.append(sums_x / sizes, x[-1])
+    avg_y = np.append(sums_y / sizes, y[-1])
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Twice the triangle area, the constant factor does not change the maximum
+        areas = np.abs((x[previous] - avg_x[bucket + 1]) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end]) * (avg_y[bucket + 1] - y[previous]))
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
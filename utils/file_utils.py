@@ -1,73 +1,161 @@
 import os
+import copy
 import json
 import time
+import struct
+import threading
 import traceback
 
-def get_data(file_path="Config/config.json"):
+DEFAULT_CONFIG = {
+    "config": {
+        "location": "",
+        "hysteresis": 1,
+        "alert_interval": 2,
+        "daily_report_time": "17:30",
+        "armed": True,
+        "send_daily_report": True,
+        "repeat_alerts": True,
+        "min_sample_interval": 2,
+        "max_sample_interval": 30
+    },
+    "sensors": {},
+    "numbers": [],
+    "modems": ["/dev/ttyS0"],
+    "sensor_dir": "/sys/bus/w1/devices/"
+}
+
+
+class ConfigStore:
     """
-    Get data from Lab Monitor configuration file, returns saved data if file is found 
-    or makes a default file and returns default configuration
+    Holds the parsed configuration file in memory so reading it costs nothing.
+
+    The file is only parsed again when its mtime changes, e.g. after an edit by hand.
+    Every change is made on a copy that replaces the data when done, so a dict returned by get()
+    never changes under a reader, and bumps version so readers can tell when to rebuild.
+    Writes are coalesced: changes within write_delay seconds are written once, through a
+    temporary file renamed over the config so a power loss never leaves a torn file.
     """
-    default =  {
-            "config": {
-                "location": "",
-                "hysteresis": 1,
-                "alert_interval": 2,
-                "daily_report_time": "17:30",
-                "armed": True,
-                "send_daily_report": True,
-                "repeat_alerts": True
-            },
-            "sensors": {},
-            "numbers": []
-        }
-    try:
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-            return data
-    except (OSError, json.JSONDecodeError) as e:
-        print(f"Error reading file, Path:{file_path} Error: {str(e)}")
-        print("Making default file")
+    def __init__(self, file_path: str = "Config/config.json", write_delay: float = 0.5):
+        self.file_path = file_path
+        self.write_delay = write_delay      # Seconds to wait for more changes before writing
+        self.lock = threading.RLock()       # Used by the web, monitor and modem threads
+        self.data = None
+        self.version = 0                    # Bumped on every change or reload
+        self.mtime = None                   # mtime of the file when it was last read or written
+        self.timer = None                   # Pending coalesced write
+
+    def get(self) -> dict:
+        """Returns the configuration, do not modify it, use update()"""
+        return self.snapshot()[0]
+
+    def snapshot(self) -> tuple:
+        """Returns (configuration, version), reloading the file if it changed on disk"""
+        with self.lock:
+            if self.data is None or (self.timer is None and self.file_mtime() != self.mtime):
+                self.load()
+            return self.data, self.version
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.file_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self) -> None:
+        """Reads the file or makes a default file if it cannot be read"""
+        try:
+            with open(self.file_path, 'r') as file:
+                self.data = json.load(file)
+            self.mtime = self.file_mtime()
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error reading file, Path:{self.file_path} Error: {str(e)}")
+            print("Making default file")
+            self.data = copy.deepcopy(DEFAULT_CONFIG)
+            self.write()
+        self.version += 1
+
+    def update(self, change) -> object:
+        """
+        Applies a change to a copy of the configuration and schedules the write.
+
+        :param change: Function taking the configuration dict and modifying it, returning False
+                       leaves the configuration untouched
+        :return: What change returned
+        """
+        with self.lock:
+            data = copy.deepcopy(self.get())
+            result = change(data)
+            if result is False:
+                return result
+            self.data = data
+            self.version += 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.write_delay, self.flush)
+                self.timer.start()      # Not a daemon so a pending write finishes before exit
+            return result
+
+    def flush(self) -> None:
+        """Writes a pending change now"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+                self.write()
+
+    def write(self) -> None:
+        """Writes the configuration atomically: temporary file, fsync, rename"""
+        temp_path = f"{self.file_path}.tmp"
         try:
-            with open(file_path, 'w') as file:
-                json.dump(default, file, indent=4)
+            with open(temp_path, 'w') as file:
+                json.dump(self.data, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.file_path)
+            self.mtime = self.file_mtime()
         except OSError as e:
-            print(f"Error writing default config to file: {str(e)}")
-        return default
+            print(f"Error writing config file: {e}")
+
+
+stores = {}     # File path -> ConfigStore
+stores_lock = threading.Lock()
+
+def get_store(file_path="Config/config.json") -> ConfigStore:
+    """Returns the one ConfigStore of a file"""
+    with stores_lock:
+        if file_path not in stores:
+            stores[file_path] = ConfigStore(file_path)
+        return stores[file_path]
+
+def get_data(file_path="Config/config.json"):
+    """
+    Get data from Lab Monitor configuration file, returns saved data if file is found 
+    or makes a default file and returns default configuration.
+    The data is cached, it must not be modified.
+    """
+    return get_store(file_path).get()
     
 def add_number_to_file(name, number, daily_sms, admin, file_path="Config/config.json"):
-    try:
-        data = get_data(file_path)
-        new_contact = {
-            "name": name,
-            "number": number,
-            "daily_sms": daily_sms,
-            "admin": admin
-        }
-        data["numbers"].append(new_contact)
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-    except (OSError, json.JSONDecodeError) as e:
-        print(f"Error adding number to file: {e}")
+    new_contact = {
+        "name": name,
+        "number": number,
+        "daily_sms": daily_sms,
+        "admin": admin
+    }
+    get_store(file_path).update(lambda data: data["numbers"].append(new_contact))
 
 def remove_number_by_index(index, file_path="Config/config.json"):
     index -= 1
-    try:
-        data = get_data(file_path)
+    def remove(data):
         numbers = data["numbers"]
         if 0 <= index < len(numbers):
             numbers.pop(index)
         else:
             print(f"Index {index + 1} is out of range.")
-
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-    except (OSError, json.JSONDecodeError) as e:
-        print(f"Error removing number by index: {e}")
+            return False
+    get_store(file_path).update(remove)
 
 def update_config(location=None, hys=None, interval=None, daily_report_time=None, send_daily_report=None, armed=None, repeat_alerts=None, file_path="Config/config.json"):
-    try:
-        data = get_data(file_path)
+    def change(data):
         config = data["config"]
         if location is not None:
             config['location'] = location   
@@ -83,98 +171,183 @@ def update_config(location=None, hys=None, interval=None, daily_report_time=None
             config['send_daily_report'] = send_daily_report
         if repeat_alerts is not None:
             config['repeat_alerts'] = repeat_alerts
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-    except (OSError, json.JSONDecodeError) as e:
+    try:
+        get_store(file_path).update(change)
+    except ValueError as e:
         print(f"Error updating config: {e}")
 
 def add_new_sensor(sensors, file_path="Config/config.json"):
     """Checks the list of detected sensors,
-    ignores if already in the config or will add it to config with defualt values
+    ignores if already in the config or will add it to config with defualt values.
+    The file is only written if a sensor was added, returns True in that case.
     """
-    data = get_data(file_path)
-    sensor_config = data["sensors"]
-    
-    # Adding if the sensor does not exist
-    for sensor in sensors:
-        if sensor not in sensor_config:
-            sensor_config[sensor] = {"name": "Unknown", "trigger": 99}  # Add default sensor
-    try:
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-    except (OSError, json.JSONDecodeError) as e:
-        print(f"Error adding new sensor: {e}")
+    def add(data):
+        sensor_config = data["sensors"]
+        # Adding if the sensor does not exist
+        new_sensors = [sensor for sensor in sensors if sensor not in sensor_config]
+        if not new_sensors:
+            return False
+        for sensor in new_sensors:
+            sensor_config[sensor] = {"name": "Unknown", "trigger": 99, "resolution": 12}  # Add default sensor
+        return True
+    return get_store(file_path).update(add)
 
-def update_sensor_data(serial, name, trigger, file_path="Config/config.json"):
-    """ Edit sensor name and trigger based on sensor serial. """
-    data = get_data(file_path)
-    sensor_config = data["sensors"]
-   
-    if serial in sensor_config:
+def update_sensor_data(serial, name, trigger, resolution=None, file_path="Config/config.json"):
+    """ Edit sensor name, trigger and resolution (bits) based on sensor serial. """
+    def change(data):
+        sensor_config = data["sensors"]
+        if serial not in sensor_config:
+            print("Cannot update, could not find sensor in config")
+            return False
         sensor_config[serial]['name'] = name
         sensor_config[serial]['trigger'] = int(trigger)
-        updated_sensor = sensor_config[serial]  # Store the updated sensor
-    else:
-        updated_sensor = None  # Return None if no matching sensor
-
-    if updated_sensor:
-        try:
-            with open(file_path, 'w') as file:
-                json.dump(data, file, indent=4)
-        except (OSError, json.JSONDecodeError) as e:
-            print(f"Error updating sensor data: {e}")
-    else:
-        print("Cannot update, could not find sensor in config")
+        if resolution is not None:
+            sensor_config[serial]['resolution'] = int(resolution)
+    try:
+        get_store(file_path).update(change)
+    except ValueError as e:
+        print(f"Error updating sensor data: {e}")
 
 def apply_trigger_all(trigger, file_path="Config/config.json"):
-    """ Edit sensor name and trigger based on sensor serial. """
-    data = get_data(file_path)
-    sensor_config = data["sensors"]
-   
-    for serial, info in sensor_config.items():
-        info['trigger'] = int(trigger)
-
+    """ Set the trigger of every sensor. """
+    def change(data):
+        for serial, info in data["sensors"].items():
+            info['trigger'] = int(trigger)
     try:
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-    except (OSError, json.JSONDecodeError) as e:
+        get_store(file_path).update(change)
+    except ValueError as e:
         print(f"Error updating sensor data: {e}")
 
         
-def write_history(event, file_path="Config/events.json"):
+HISTORY_FILE = "Config/events.jsonl"     # One JSON event per line, only ever appended to
+HISTORY_INDEX = "Config/events.idx"     # Byte offset of each line as a fixed-width 8 byte integer
+LEGACY_HISTORY_FILE = "Config/events.json"
+OFFSET = struct.Struct("<Q")
+history_lock = threading.Lock()         # Events are written by the monitor, modem and web threads
+
+
+def migrate_history(file_path=HISTORY_FILE, index_path=HISTORY_INDEX, legacy_path=LEGACY_HISTORY_FILE):
+    """Moves the events of the old events.json list to the log once, the old file is renamed to .migrated"""
+    if os.path.exists(file_path) or not os.path.exists(legacy_path):
+        return
+    try:
+        with open(legacy_path, "r") as file:
+            events = json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error reading old history file: {e}")
+        events = []
+    try:
+        with open(file_path, "wb") as log, open(index_path, "wb") as index:
+            for event in events:
+                index.write(OFFSET.pack(log.tell()))
+                log.write(json.dumps(event).encode() + b"\n")
+        os.rename(legacy_path, legacy_path + ".migrated")
+    except OSError as e:
+        print(f"Error migrating history file: {e}")
+
+def sync_history_index(file_path=HISTORY_FILE, index_path=HISTORY_INDEX) -> int:
+    """
+    Makes the index cover every complete line of the log, e.g. after a crash between the two appends,
+    only the lines after the last indexed one are scanned. Returns the number of events.
+    """
+    try:
+        log_size = os.path.getsize(file_path)
+    except OSError:
+        return 0
+    with open(index_path, "ab+") as index, open(file_path, "rb") as log:
+        index_size = index.seek(0, os.SEEK_END)
+        count = index_size // OFFSET.size
+        if index_size % OFFSET.size:        # Torn write of an offset
+            index.truncate(count * OFFSET.size)
+        if count:
+            index.seek((count - 1) * OFFSET.size)
+            last, = OFFSET.unpack(index.read(OFFSET.size))
+            log.seek(last)
+            log.readline()      # Skip the last indexed line
+        offset = log.tell()
+        if offset >= log_size:
+            return count
+        index.seek(0, os.SEEK_END)
+        for line in log:
+            if not line.endswith(b"\n"):   # Torn last line is ignored
+                break
+            index.write(OFFSET.pack(offset))
+            offset += len(line)
+            count += 1
+    return count
+
+def write_history(event, file_path=HISTORY_FILE, index_path=HISTORY_INDEX):
+    """Appends an event to the history log, the cost does not depend on the size of the history"""
     history = {
         "event": event,
         "time": time.strftime("%I:%M %p, %b %d, %Y")
     } 
-    try:
-        with open(file_path, "r") as file:
-            try:
-                history_data = json.load(file)
-            except json.JSONDecodeError as e:
-                history_data = []
-            history_data.append(history)
-            with open(file_path, "w") as file:
-                json.dump(history_data, file, indent=4)
-    except OSError as e:
-        print(f"Error writing to history file: {e}")   
+    line = json.dumps(history).encode() + b"\n"
+    with history_lock:
+        try:
+            migrate_history(file_path, index_path)
+            sync_history_index(file_path, index_path)     # Reads only the last line when in sync
+            with open(file_path, "ab+") as log:
+                offset = log.seek(0, os.SEEK_END)
+                if offset and log.seek(-1, os.SEEK_END) and log.read(1) != b"\n":     # End a line torn by a crash
+                    line = b"\n" + line
+                    offset += 1
+                log.write(line)
+            with open(index_path, "ab") as index:
+                index.write(OFFSET.pack(offset))
+        except OSError as e:
+            print(f"Error writing to history file: {e}")   
 
-def get_history_data(file_path="Config/events.json") -> list[str]: 
-    """Get history data"""
-    try:
-        with open(file_path, 'r') as file:
-            history = json.load(file)
-            history.reverse()
-            return history
-    except (OSError, json.JSONDecodeError) as e:
-        print(f"Error reading history data: {e}")
-        return []
+def get_history_page(page=1, per_page=50, file_path=HISTORY_FILE, index_path=HISTORY_INDEX) -> tuple:
+    """
+    Gets one page of history, newest events first. Only the offsets and lines of that page are read.
+    
+    :param page: Page number starting at 1, clamped to the existing pages
+    :param per_page: Events per page
+    :return: (list of events, page, number of pages)
+    """
+    with history_lock:
+        try:
+            migrate_history(file_path, index_path)
+            total = sync_history_index(file_path, index_path)
+            pages = max((total + per_page - 1) // per_page, 1)
+            page = min(max(int(page), 1), pages)
+            end = total - (page - 1) * per_page     # Events [first, end) in file order
+            first = max(end - per_page, 0)
+            if end <= first:
+                return [], page, pages
+            with open(index_path, "rb") as index:
+                index.seek(first * OFFSET.size)
+                start, = OFFSET.unpack(index.read(OFFSET.size))
+                index.seek(end * OFFSET.size)
+                following = index.read(OFFSET.size)
+            with open(file_path, "rb") as log:
+                log.seek(start)
+                if following:
+                    stop, = OFFSET.unpack(following)
+                    data = log.read(stop - start)
+                else:
+                    data = log.read()
+        except (OSError, ValueError) as e:
+            print(f"Error reading history data: {e}")
+            return [], 1, 1
+    history = []
+    for line in data.splitlines():
+        try:
+            history.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    history.reverse()
+    return history, page, pages
    
-def clear_history(file_path="Config/events.json"):
-    try:
-        with open(file_path, "w") as file:
-            json.dump([], file, indent=4)
-    except OSError as e:
-        print(f"Error writing to history file: {e}")   
+def clear_history(file_path=HISTORY_FILE, index_path=HISTORY_INDEX):
+    with history_lock:
+        try:
+            migrate_history(file_path, index_path)
+            open(file_path, "wb").close()
+            open(index_path, "wb").close()
+        except OSError as e:
+            print(f"Error writing to history file: {e}")   
         
         
 if __name__ == '__main__':
@@ -0,0 +1,328 @@
+"""
+SMS-SUBMIT PDU encoding for sending SMS in PDU mode (AT+CMGF=0) and
+SMS-DELIVER decoding for reading the messages AT+CMGL lists.
+
+Text is encoded in the GSM 7-bit default alphabet (with the extension table) when
+possible and in UCS-2 only when it has a character GSM-7 cannot represent.
+Long messages are split into concatenated parts with a User Data Header so the
+handset shows them as one message.
+References: 3GPP TS 23.040 (PDU layout) and 3GPP TS 23.038 (alphabets).
+"""
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# GSM 03.38 default alphabet, index is the septet value
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_BASIC_INDEX = {char: index for index, char in enumerate(GSM7_BASIC) if char != "\x1b"}
+# Extension table, sent as ESC (0x1B) followed by the value
+GSM7_EXTENSION = {"\f": 0x0A, "^": 0x14, "{": 0x28, "}": 0x29, "\\": 0x2F, "[": 0x3C, "~": 0x3D, "]": 0x3E,
+                  "|": 0x40, "€": 0x65}
+GSM7_ESCAPE = 0x1B
+
+GSM7_SINGLE_LIMIT = 160     # Septets in a single message
+GSM7_PART_LIMIT = 153       # Septets per part after the 6 octet concatenation header (+1 fill bit)
+UCS2_SINGLE_LIMIT = 70      # UTF-16 code units in a single message
+UCS2_PART_LIMIT = 67        # UTF-16 code units per part after the concatenation header
+MAX_PARTS = 255             # The concatenation header counts parts in one octet
+
+DCS_GSM7 = 0x00
+DCS_UCS2 = 0x08
+
+BREAK_CHARS = ([GSM7_BASIC_INDEX["\n"]], [GSM7_BASIC_INDEX[" "]], "\n".encode("utf-16-be"), " ".encode("utf-16-be"))
+
+
+def gsm7_chars(text: str) -> Optional[List[List[int]]]:
+    """
+    Encodes text as GSM-7 septets, one list per character so extension
+    characters (2 septets) are never split between parts.
+    Returns None if a character is not in the GSM-7 alphabet.
+    """
+    chars = []
+    for char in text:
+        if char in GSM7_BASIC_INDEX:
+            chars.append([GSM7_BASIC_INDEX[char]])
+        elif char in GSM7_EXTENSION:
+            chars.append([GSM7_ESCAPE, GSM7_EXTENSION[char]])
+        else:
+            return None
+    return chars
+
+
+def ucs2_chars(text: str) -> List[bytes]:
+    """Encodes text as UTF-16BE, one entry per character so surrogate pairs (emoji) are never split"""
+    return [char.encode("utf-16-be") for char in text]
+
+
+def split_units(chars: list, size, single_limit: int, part_limit: int) -> List[list]:
+    """
+    Splits encoded characters into parts, each part holds at most part_limit units
+    (single_limit if everything fits in one message). Prefers to break after a
+    newline or space in the last fifth of a part so words are not cut.
+
+    :param chars: Encoded characters
+    :param size: Function returning the number of units of an encoded character
+    """
+    if sum(size(char) for char in chars) <= single_limit:
+        return [chars]
+
+    parts = []
+    start = 0
+    while start < len(chars):
+        units = 0
+        end = start
+        while end < len(chars) and units + size(chars[end]) <= part_limit:
+            units += size(chars[end])
+            end += 1
+        if end < len(chars):
+            # Break after the last newline or space near the end of the part
+            for brk in range(end - 1, start + (end - start) * 4 // 5, -1):
+                if chars[brk] in BREAK_CHARS:
+                    end = brk + 1
+                    break
+        parts.append(chars[start:end])
+        start = end
+    return parts
+
+
+def split_message(text: str) -> Tuple[int, List[list]]:
+    """
+    Chooses the alphabet for a text and splits it into parts.
+
+    :return: Data coding scheme and the encoded characters of each part
+    """
+    chars = gsm7_chars(text)
+    if chars is not None:
+        return DCS_GSM7, split_units(chars, len, GSM7_SINGLE_LIMIT, GSM7_PART_LIMIT)
+    chars = ucs2_chars(text)
+    return DCS_UCS2, split_units(chars, lambda char: len(char) // 2, UCS2_SINGLE_LIMIT, UCS2_PART_LIMIT)
+
+
+def count_parts(text: str) -> int:
+    """Returns the number of SMS a text is sent as"""
+    return len(split_message(text)[1])
+
+
+def pack_septets(septets: List[int], fill_bits: int = 0) -> bytes:
+    """
+    Packs 7-bit values into octets, least significant bit first.
+
+    :param fill_bits: Zero bits before the first septet, aligns the text after a User Data Header
+    """
+    if (fill_bits + 7 * len(septets)) % 8 == 1:
+        septets = septets + [GSM7_BASIC_INDEX["\r"]]    # 7 spare bits would read as '@', pad with CR instead
+    packed = bytearray()
+    acc = 0
+    bits = fill_bits
+    for septet in septets:
+        acc |= septet << bits
+        bits += 7
+        while bits >= 8:
+            packed.append(acc & 0xFF)
+            acc >>= 8
+            bits -= 8
+    if bits:
+        packed.append(acc)
+    return bytes(packed)
+
+
+def encode_address(number: str) -> bytes:
+    """Encodes a phone number as a TP-DA: digit count, type of address and swapped BCD digits"""
+    international = number.startswith("+")
+    digits = "".join(char for char in number if char.isdigit())
+    padded = digits + "F" if len(digits) % 2 else digits
+    swapped = "".join(padded[i + 1] + padded[i] for i in range(0, len(padded), 2))
+    return bytes([len(digits), 0x91 if international else 0x81]) + bytes.fromhex(swapped)
+
+
+def build_user_data(dcs: int, chars: list, udh: bytes = b"") -> Tuple[int, bytes]:
+    """
+    Encodes the characters of one part as TP-User-Data after an optional User Data Header.
+
+    :return: TP-UDL (septets for GSM-7, octets for UCS-2) and the user data
+    """
+    if dcs == DCS_GSM7:
+        septets = [septet for char in chars for septet in char]
+        fill_bits = (7 - len(udh) * 8 % 7) % 7
+        return (len(udh) * 8 + fill_bits) // 7 + len(septets), udh + pack_septets(septets, fill_bits)
+    user_data = udh + b"".join(chars)
+    return len(user_data), user_data
+
+
+def concat_header(reference: int, total: int, seq: int) -> bytes:
+    """Returns the User Data Header of one part of a concatenated message (8-bit reference)"""
+    return bytes([0x05, 0x00, 0x03, reference & 0xFF, total, seq])
+
+
+def build_submit_pdus(number: str, text: str, reference: int = 0) -> List[Tuple[str, int]]:
+    """
+    Builds the SMS-SUBMIT PDUs for a text, concatenated with a User Data Header if it needs more than one part.
+
+    :param number: Destination phone number, international numbers start with '+'
+    :param text: Message text
+    :param reference: Concatenation reference (0-255), must differ between consecutive long messages
+    :return: List of (PDU as hex, TPDU length for AT+CMGS) tuples
+    """
+    dcs, parts = split_message(text)
+    if len(parts) > MAX_PARTS:
+        raise ValueError(f"Message needs {len(parts)} parts, more than {MAX_PARTS}")
+
+    pdus = []
+    for seq, chars in enumerate(parts, start=1):
+        udh = concat_header(reference, len(parts), seq) if len(parts) > 1 else b""
+        udl, user_data = build_user_data(dcs, chars, udh)
+        first_octet = 0x01 | (0x40 if udh else 0x00)                # SMS-SUBMIT, UDHI if there is a header
+        tpdu = (bytes([first_octet, 0x00]) + encode_address(number)  # Message reference set by the modem
+                + bytes([0x00, dcs, udl]) + user_data)
+        pdus.append(("00" + tpdu.hex().upper(), len(tpdu)))         # 00: use the SMSC stored on the SIM
+    return pdus
+
+
+def build_deliver_pdus(sender: str, text: str, reference: int = 0,
+                       timestamp: Optional[float] = None) -> List[Tuple[str, int]]:
+    """
+    Builds the SMS-DELIVER PDUs a handset's message arrives as, used by the emulator.
+
+    :param sender: Originating phone number
+    :param text: Message text
+    :param reference: Concatenation reference (0-255)
+    :param timestamp: Service centre time stamp, defaults to now
+    :return: List of (PDU as hex, TPDU length) tuples, as listed by AT+CMGL in PDU mode
+    """
+    dcs, parts = split_message(text)
+    t = time.gmtime(timestamp)
+    digits = f"{t.tm_year % 100:02d}{t.tm_mon:02d}{t.tm_mday:02d}{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}00"
+    scts = bytes.fromhex("".join(digits[i + 1] + digits[i] for i in range(0, len(digits), 2)))
+
+    pdus = []
+    for seq, chars in enumerate(parts, start=1):
+        udh = concat_header(reference, len(parts), seq) if len(parts) > 1 else b""
+        udl, user_data = build_user_data(dcs, chars, udh)
+        first_octet = 0x04 | (0x40 if udh else 0x00)                # SMS-DELIVER, no more messages, UDHI
+        tpdu = bytes([first_octet]) + encode_address(sender) + bytes([0x00, dcs]) + scts + bytes([udl]) + user_data
+        pdus.append(("00" + tpdu.hex().upper(), len(tpdu)))
+    return pdus
+
+
+def unpack_septets(data: bytes, count: int, bit_offset: int = 0) -> List[int]:
+    """
+    Unpacks 7-bit values packed least significant bit first, the reverse of pack_septets.
+
+    :param count: Number of septets to read
+    :param bit_offset: Bits to skip first, e.g. a User Data Header and its fill bits
+    """
+    value = int.from_bytes(data, "little")
+    return [(value >> (bit_offset + 7 * i)) & 0x7F for i in range(count)]
+
+
+def decode_gsm7(septets: List[int]) -> str:
+    """Decodes GSM-7 septets, including extension characters, to text"""
+    extension = {value: char for char, value in GSM7_EXTENSION.items()}
+    chars = []
+    escaped = False
+    for septet in septets:
+        if escaped:
+            chars.append(extension.get(septet, " "))
+            escaped = False
+        elif septet == GSM7_ESCAPE:
+            escaped = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return "".join(chars)
+
+
+def decode_address(data: bytes, offset: int) -> Tuple[str, int]:
+    """
+    Decodes a TP-OA/TP-DA address.
+
+    :return: The number (or alphanumeric sender name) and the offset after the address
+    """
+    length, toa = data[offset], data[offset + 1]
+    octets = (length + 1) // 2                  # The length counts semi-octets
+    raw = data[offset + 2:offset + 2 + octets]
+    if toa & 0x70 == 0x50:                      # Alphanumeric, e.g. a carrier's sender name
+        return decode_gsm7(unpack_septets(raw, length * 4 // 7)), offset + 2 + octets
+    swapped = raw.hex().upper()
+    number = "".join(swapped[i + 1] + swapped[i] for i in range(0, len(swapped), 2))[:length]
+    return ("+" if toa & 0x70 == 0x10 else "") + number, offset + 2 + octets
+
+
+def parse_deliver_pdu(pdu: str) -> dict:
+    """
+    Decodes an SMS-DELIVER PDU as listed by AT+CMGL in PDU mode.
+
+    :param pdu: PDU in hex, starting with the SMSC address
+    :return: {"number", "text", "timestamp", "concat"}, concat is (reference, total, seq) for a part of a
+             concatenated message and None otherwise
+    :raises ValueError: If the PDU is malformed
+    """
+    try:
+        data = bytes.fromhex(pdu.strip())
+        offset = data[0] + 1                    # Skip the SMSC address
+        first_octet = data[offset]
+        number, offset = decode_address(data, offset + 1)
+        dcs = data[offset + 1]
+        digits = data[offset + 2:offset + 9].hex()
+        digits = "".join(digits[i + 1] + digits[i] for i in range(0, len(digits), 2))
+        timestamp = f"{digits[0:2]}/{digits[2:4]}/{digits[4:6]},{digits[6:8]}:{digits[8:10]}:{digits[10:12]}"
+        udl = data[offset + 9]
+        user_data = data[offset + 10:]
+
+        if dcs & 0xC0 == 0x00:                  # General data coding, alphabet in bits 2-3
+            alphabet = (dcs >> 2) & 0x03
+        elif dcs & 0xF0 == 0xF0:                # Data coding/message class, bit 2 is 8-bit data
+            alphabet = 1 if dcs & 0x04 else 0
+        else:                                   # Message waiting indication groups
+            alphabet = 2 if dcs & 0xF0 == 0xE0 else 0
+
+        concat = None
+        header_octets = 0
+        if first_octet & 0x40:                  # User Data Header present
+            udhl = user_data[0]
+            header_octets = udhl + 1
+            i = 1
+            while i < header_octets:
+                iei, length = user_data[i], user_data[i + 1]
+                value = user_data[i + 2:i + 2 + length]
+                if iei == 0x00 and length == 3:     # Concatenation, 8-bit reference
+                    concat = (value[0], value[1], value[2])
+                elif iei == 0x08 and length == 4:   # Concatenation, 16-bit reference
+                    concat = (value[0] << 8 | value[1], value[2], value[3])
+                i += 2 + length
+
+        if alphabet == 0:
+            fill_bits = (7 - header_octets * 8 % 7) % 7
+            header_septets = (header_octets * 8 + fill_bits) // 7
+            text = decode_gsm7(unpack_septets(user_data, udl - header_septets, header_octets * 8 + fill_bits))
+        elif alphabet == 2:
+            text = user_data[header_octets:udl].decode("utf-16-be", errors="replace")
+        else:
+            text = user_data[header_octets:udl].decode("latin1")
+    except (IndexError, ValueError) as e:
+        raise ValueError(f"Malformed SMS-DELIVER PDU: {e}")
+    return {"number": number, "text": text, "timestamp": timestamp, "concat": concat}
+
+
+def parse_cmgl(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    Parses an AT+CMGL listing in PDU mode (AT+CMGF=0), each header is followed by one PDU line.
+
+    :param lines: Reply lines of AT+CMGL without the final result code
+    :return: {"index", "number", "text", "concat"} per message, number and text are None for an undecodable PDU
+    """
+    index = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith("+CMGL:"):
+            index = int(line[len("+CMGL:"):].split(",")[0])
+        elif index is None or not line:
+            continue
+        else:
+            try:
+                message = parse_deliver_pdu(line)
+            except ValueError:
+                message = {"number": None, "text": None, "concat": None}
+            yield {"index": index, "number": message["number"], "text": message["text"], "concat": message["concat"]}
+            index = None
@@ -21,3 +21,7 @@ def is_positive_number(n):
         return n > 0
     except ValueError:
         return False
+
+def is_sensor_serial(serial):
+    """True for a DS18B20 serial as found in its w1 folder name, 12 lowercase hex digits"""
+    return re.fullmatch(r'[0-9a-f]{12}', serial) is not None